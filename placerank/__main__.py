@@ -5,12 +5,13 @@ from placerank.query_expansion import *
 from placerank.ir_model import *
 from placerank.models import *
 from placerank.sentiment import BaseSentimentWeightingModel
-from placerank.dataset import ReviewsDatabase
-from placerank.config import INDEX_DIR, HELP_FILENAME, DATASET_CACHE_FILE, HF_CACHE, REVIEWS_DB, REVIEWS_INDEX
+from placerank.dataset import ReviewsDatabase, ListingStore
+from placerank.config import INDEX_DIR, HELP_FILENAME, LISTINGS_DB, HF_CACHE, REVIEWS_DB, REVIEWS_INDEX, RERANK_DEPTH, SYNONYM_TABLE
 from whoosh.index import open_dir
 from whoosh.scoring import TF_IDF, BM25F
 from urwid import MainLoop, ExitMainLoop
 import signal
+import os
 
 
 def sigint_handler(signum, frame):
@@ -23,10 +24,16 @@ def main() -> None:
         window = Window(readme.read())
     
     idx = open_dir(INDEX_DIR)
-    model = UnionIRModel(WhooshSpellCorrection, ThesaurusQueryExpansion(HF_CACHE), idx, BaseSentimentWeightingModel(REVIEWS_INDEX))
-    presenter = Presenter(model, DATASET_CACHE_FILE, ReviewsDatabase(REVIEWS_DB))
+    model = UnionIRModel(WhooshSpellCorrection, ThesaurusQueryExpansion(HF_CACHE, SYNONYM_TABLE if os.path.exists(SYNONYM_TABLE) else None), idx, BaseSentimentWeightingModel(REVIEWS_INDEX), rerank_depth = RERANK_DEPTH)
+    presenter = Presenter(model, ListingStore(LISTINGS_DB), ReviewsDatabase(REVIEWS_DB))
     loop = MainLoop(window, palette=PALETTE)
-    loop.run()
+    presenter.attach(loop)
+    loop.set_alarm_in(0, lambda *_: presenter.warm_up())  # Fires once the first frame is drawn
+
+    try:
+        loop.run()
+    finally:
+        presenter.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
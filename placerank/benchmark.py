@@ -1,14 +1,25 @@
 """
 Module to test performance of an index against predefined queries.
+Run it to benchmark quality, latency and memory of several model variants, in parallel, and save a JSON report.
 """
 
 from placerank.ir_model import *
 from placerank.models import *
 from placerank.config import *
 from placerank.query_expansion import *
+from placerank.cache import Lazy
 from whoosh.scoring import TF_IDF
 from whoosh.index import open_dir
+from typing import Callable, Dict, List, NamedTuple
+from datetime import datetime
+import argparse
 import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import numpy as np
 from operator import itemgetter
 
 def mean(l):
@@ -71,20 +82,27 @@ class Benchmark:
         """
         Tests the benchmark against a given index.
         This is the first call needed to compute different measures.
+        
+        Latency and per-stage timings of each search are kept in `latencies` and `timings`.
         """
         
-        # Produce a list of (query, retrieve_results)
-        self.__results = [
-            (q, ir_model.search(
+        # Produce a list of (query, search_result, latency)
+        searches = []
+
+        for q in self.__dset.queries:
+            start = time.perf_counter()
+            result = ir_model.search(
                 QueryView(
                     textual_query=q.text,
                     sentiment_tags=" ".join(q.sentiments),
                     search_fields=SearchFields.DESCRIPTION | SearchFields.NEIGHBORHOOD_OVERVIEW | SearchFields.NAME
                 )
-            )[0]) for q in self.__dset.queries
-        ]
+            )
+            searches.append((q, result, time.perf_counter() - start))
 
-        self.__results = [(q, [int(a.id) for a in answer]) for q, answer in self.__results]
+        self.__results = [(q, [int(a.id) for a in result[0]]) for q, result, _ in searches]
+        self.latencies = [latency for _, _, latency in searches]
+        self.timings = [result.timings for _, result, _ in searches]
 
         self.results = self.__results
         #TODO: remove self.results. Now permits inspection of the object without debugger
@@ -191,6 +209,32 @@ class Benchmark:
     def mean_f1(self):
         return mean([f1 for q, f1 in self.f1()])
 
+    def ann_recall(self, dense_model: DenseIRModel, k: int = 10, nprobes = (1, 2, 4, 8, 16, 32)):
+        """
+        Recall@k of approximate dense search with respect to the exact one over the benchmark queries,
+        for increasing numbers of probed clusters. Each entry also reports the recall@k of the relevant
+        listings and the mean search latency in seconds; exact search comes first, with `nprobe` None.
+        """
+        vectors = dense_model.encoder.encode([q.text for q in self.__dset.queries])
+        relevant = [set(map(str, q.relevant)) for q in self.__dset.queries]
+        exact = None
+        report = []
+
+        for nprobe in (None, *nprobes):
+            start = time.perf_counter()
+            answers = [set(dense_model.dense_index.ids[dense_model._nearest(v, k, nprobe = nprobe)[0]]) for v in vectors]
+            latency = (time.perf_counter() - start) / len(vectors)
+            exact = exact or answers
+
+            report.append({
+                "nprobe": nprobe,
+                "recall_vs_exact": mean([len(a & e) / len(e) for a, e in zip(answers, exact) if e]),
+                "relevant_recall": mean([self._compute_set_recall(r, a) for a, r in zip(answers, relevant) if r]),
+                "latency": latency,
+            })
+
+        return report
+
     def test_and_print(bench, model):
         bench.test_against(model)
         for (query, results), (_q, precision), (__q, recall) in zip(bench.__results, bench.precision(), bench.recall()):
@@ -202,68 +246,196 @@ class Benchmark:
         print()
 
 
-def main():
+class SharedServices:
     """
-    Test program for benchmark loading.
+    Index and models shared by all the variants benchmarked in a process: each one is loaded
+    at most once, when the first variant needing it runs.
     """
 
-    bench = Benchmark()
+    def __init__(self, index_dir: str = INDEX_DIR, hf_cache: str = HF_CACHE):
+        self._index = Lazy(lambda: open_dir(index_dir))
+        self.thesaurus = ThesaurusQueryExpansion(hf_cache)
+        self.llm = LLMQueryExpansion(hf_cache)
+        self.dense_encoder = DenseEncoder(hf_cache)
+        self.sentiment = BaseSentimentWeightingModel(REVIEWS_INDEX)
 
-    idx = open_dir(INDEX_DIR)
-    base_model = IRModel(NoSpellCorrection, ThesaurusQueryExpansion(HF_CACHE), idx)
+    index = property(lambda self: self._index.get())
 
-    print("Model 1 - Base model (terms in AND)")
-    bench.test_and_print(base_model)
 
+def _autoexpanded(model: IRModel) -> IRModel:
+    model.set_autoexpansion(True)
+    return model
 
-    print("Model 2 - With query expansion")
-    base_model.set_autoexpansion(True)
-    bench.test_and_print(base_model)
 
+class Variant(NamedTuple):
+    """
+    A benchmarked model configuration. Variants of the same `group` share their heavy models,
+    so they run one after the other in the same process.
+    """
+    description: str
+    group: str
+    build: Callable[[SharedServices], IRModel]
+
+
+# Search results are not cached, so that repeated runs measure actual searches
+VARIANTS: Dict[str, Variant] = {
+    "base": Variant("Base model (terms in AND)", "thesaurus",
+        lambda s: IRModel(NoSpellCorrection, s.thesaurus, s.index, cache_size = 0)),
+    "base-expanded": Variant("With query expansion", "thesaurus",
+        lambda s: _autoexpanded(IRModel(NoSpellCorrection, s.thesaurus, s.index, cache_size = 0))),
+    "or-tfidf": Variant("OR terms model (overcoming of whoosh scoring)", "thesaurus",
+        lambda s: UnionIRModel(NoSpellCorrection, s.thesaurus, s.index, TF_IDF, cache_size = 0)),
+    "or-tfidf-expanded": Variant("OR terms model with query expansion", "thesaurus",
+        lambda s: _autoexpanded(UnionIRModel(NoSpellCorrection, s.thesaurus, s.index, TF_IDF, cache_size = 0))),
+    "or-tfidf-llm": Variant("OR terms model with LLM query expansion", "llm",
+        lambda s: _autoexpanded(UnionIRModel(NoSpellCorrection, s.llm, s.index, TF_IDF, cache_size = 0))),
+    "or-bm25f": Variant("OR terms model with BM25F", "thesaurus",
+        lambda s: UnionIRModel(NoSpellCorrection, s.thesaurus, s.index, cache_size = 0)),
+    "or-bm25f-expanded": Variant("OR terms model with BM25F and query expansion", "thesaurus",
+        lambda s: _autoexpanded(UnionIRModel(NoSpellCorrection, s.thesaurus, s.index, cache_size = 0))),
+    "or-bm25f-llm": Variant("OR terms model with BM25F and LLM query expansion", "llm",
+        lambda s: _autoexpanded(UnionIRModel(NoSpellCorrection, s.llm, s.index, cache_size = 0))),
+    "sentiment": Variant("Sentiment Analysis", "sentiment",
+        lambda s: UnionIRModel(NoSpellCorrection, NoQueryExpansion(), s.index, s.sentiment, rerank_depth = RERANK_DEPTH, cache_size = 0)),
+    "sentiment-expanded": Variant("Sentiment Analysis with wordnet query expansion", "thesaurus",
+        lambda s: _autoexpanded(UnionIRModel(NoSpellCorrection, s.thesaurus, s.index, s.sentiment, rerank_depth = RERANK_DEPTH, cache_size = 0))),
+    "dense": Variant("Dense retrieval", "dense",
+        lambda s: DenseIRModel(NoSpellCorrection, NoQueryExpansion(), s.index, encoder = s.dense_encoder, cache_size = 0)),
+    "dense-ivf": Variant("Dense retrieval, approximate", "dense",
+        lambda s: DenseIRModel(NoSpellCorrection, NoQueryExpansion(), s.index, encoder = s.dense_encoder, nprobe = DENSE_NPROBE, cache_size = 0)),
+    "hybrid-rrf": Variant("Hybrid BM25F and dense retrieval, reciprocal rank fusion", "dense",
+        lambda s: HybridIRModel(NoSpellCorrection, NoQueryExpansion(), s.index, encoder = s.dense_encoder, cache_size = 0)),
+    "hybrid-linear": Variant("Hybrid BM25F and dense retrieval, linear fusion", "dense",
+        lambda s: HybridIRModel(NoSpellCorrection, NoQueryExpansion(), s.index, encoder = s.dense_encoder, fusion = "linear", cache_size = 0)),
+}
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of the current process, in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # Bytes on macOS, KiB elsewhere
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    return dict(zip(("p50", "p95", "p99"), np.percentile(values, (50, 95, 99)).tolist())) | {"mean": float(np.mean(values))}
 
-    print("Model 3 - OR terms model (overcoming of whoosh scoring)")
-    or_terms_model = UnionIRModel(NoSpellCorrection, ThesaurusQueryExpansion(HF_CACHE), idx, TF_IDF)
-    bench.test_and_print(or_terms_model)
 
+def run_variant(name: str, services: SharedServices, bm_dataset_path: str = "validation/benchmark.json", repeat: int = 1) -> dict:
+    """
+    Benchmark a variant: quality of its results, latency percentiles and throughput over `repeat` runs of
+    the queries, per-stage timings and peak memory. Models are loaded and warmed up, by an untimed run of the
+    queries, before timing.
+    Approximate dense variants also report their `ann_recall`.
+    """
+    bench = Benchmark(bm_dataset_path)
 
-    print("Model 4 - OR terms model with query expansion")
-    or_terms_model.set_autoexpansion(True)
-    bench.test_and_print(or_terms_model)
+    start = time.perf_counter()
+    model = VARIANTS[name].build(services)
+    model.warm_up()
+    load_time = time.perf_counter() - start
+    bench.test_against(model)
 
+    latencies, timings = [], []
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        bench.test_against(model)
+        latencies += bench.latencies
+        timings += bench.timings
 
-    print("Model 5 - OR terms model with LLM query expansion")
-    llm_expanded = UnionIRModel(NoSpellCorrection, LLMQueryExpansion(HF_CACHE), idx, TF_IDF)
-    llm_expanded.set_autoexpansion(True)
-    bench.test_and_print(llm_expanded)
+    elapsed = time.perf_counter() - start
+    stages = dict.fromkeys(stage for t in timings for stage in t)
+    report = {
+        "variant": name,
+        "description": VARIANTS[name].description,
+        "quality": {
+            "precision": mean([p for _, p in bench.precision()]),
+            "recall": mean([r for _, r in bench.recall()]),
+            "f1": bench.mean_f1(),
+            "map": bench.mean_average_precision(),
+        },
+        "latency": _percentiles(latencies),
+        "qps": len(latencies) / elapsed if elapsed else 0,
+        "stages": {stage: _percentiles([t[stage] for t in timings if stage in t]) for stage in stages},
+        "load_time": load_time,
+        "peak_rss_mb": peak_rss_mb(),
+        "pid": os.getpid(),
+    }
 
+    if isinstance(model, DenseIRModel) and model.nprobe:
+        report["ann_recall"] = bench.ann_recall(model)
 
-    print("Model 6 - OR terms model with BM25F")
-    or_terms_model = UnionIRModel(NoSpellCorrection, ThesaurusQueryExpansion(HF_CACHE), idx)
-    bench.test_and_print(or_terms_model)
+    model.close()
+    return report
 
 
-    print("Model 7 - OR terms model with BM25F and query expansion")
-    or_terms_model.set_autoexpansion(True)
-    bench.test_and_print(or_terms_model)
+_worker_services: SharedServices = None
+
+
+def _init_worker(index_dir: str, hf_cache: str) -> None:
+    global _worker_services
+    _worker_services = SharedServices(index_dir, hf_cache)
+
+
+def _run_group(names: List[str], bm_dataset_path: str, repeat: int) -> List[dict]:
+    return [run_variant(name, _worker_services, bm_dataset_path, repeat) for name in names]
+
+
+def run_variants(names: List[str], jobs: int = 1, bm_dataset_path: str = "validation/benchmark.json", repeat: int = 1, index_dir: str = INDEX_DIR, hf_cache: str = HF_CACHE) -> List[dict]:
+    """
+    Benchmark the named variants on `jobs` processes. Variants are dispatched by group, so that
+    each group loads its models once; reports are returned in the order of `names`.
+    Peak memory is the one of the process running a variant, which may have run others of its group before.
+    """
+    groups: Dict[str, List[str]] = {}
+
+    for name in names:
+        groups.setdefault(VARIANTS[name].group, []).append(name)
+
+    if jobs > 1:
+        with multiprocessing.get_context("spawn").Pool(min(jobs, len(groups)), _init_worker, (index_dir, hf_cache)) as pool:
+            reports = pool.starmap(_run_group, [(group, bm_dataset_path, repeat) for group in groups.values()], chunksize = 1)
+    else:
+        _init_worker(index_dir, hf_cache)
+        reports = [_run_group(group, bm_dataset_path, repeat) for group in groups.values()]
+
+    by_name = {report["variant"]: report for group in reports for report in group}
+    return [by_name[name] for name in names]
+
+
+def main():
+    """
+    Benchmark model variants and save the report as JSON.
+    """
+    parser = argparse.ArgumentParser(
+        prog = "Placerank benchmark",
+        description = "Measure quality, latency and memory of model variants against the benchmark queries"
+    )
 
+    parser.add_argument('-v', '--variants', nargs = '+', choices = VARIANTS.keys(), default = list(VARIANTS.keys()), metavar = 'VARIANT', help = f'Variants to run, among: {", ".join(VARIANTS)}. Defaults to all.')
+    parser.add_argument('-j', '--jobs', type = int, default = 1, help = 'Number of processes running variants. Defaults to 1.')
+    parser.add_argument('-n', '--repeat', type = int, default = 1, help = 'Runs of the benchmark queries per variant. Defaults to 1.')
+    parser.add_argument('-b', '--benchmark', default = "validation/benchmark.json", help = 'Path of the benchmark dataset.')
+    parser.add_argument('-o', '--output', help = 'Path of the JSON report. Defaults to validation/results-<timestamp>.json.')
 
-    print("Model 8 - OR terms model with BM25F and LLM query expansion")
-    llm_expanded = UnionIRModel(NoSpellCorrection, LLMQueryExpansion(HF_CACHE), idx)
-    llm_expanded.set_autoexpansion(True)
-    bench.test_and_print(llm_expanded)
+    args = parser.parse_args(sys.argv[1:])
+    output = args.output or f"validation/results-{datetime.now():%Y%m%d-%H%M%S}.json"
 
+    reports = run_variants(args.variants, args.jobs, args.benchmark, args.repeat)
 
-    print("Model 9 - Sentiment Analysis")
-    sentiment_model = SentimentAwareIRModel(NoSpellCorrection, NoQueryExpansion(), idx, SentimentRanker(REVIEWS_INDEX))
-    bench.test_against(sentiment_model)
-    bench.test_and_print(sentiment_model)
+    for r in reports:
+        print(f"{r['variant']} - {r['description']}")
+        print(f"\tF1 Mean: {r['quality']['f1']:.3f} MAP: {r['quality']['map']:.3f}")
+        print(f"\tLatency p50 {r['latency']['p50'] * 1000:.1f} ms, p95 {r['latency']['p95'] * 1000:.1f} ms, p99 {r['latency']['p99'] * 1000:.1f} ms, {r['qps']:.1f} QPS")
+        print(f"\tPeak RSS {r['peak_rss_mb']:.0f} MiB, models loaded in {r['load_time']:.1f} s")
 
+    with open(output, "w") as fp:
+        json.dump({"date": datetime.now().isoformat(), "benchmark": args.benchmark, "repeat": args.repeat, "variants": reports}, fp, indent = 2)
 
-    print("Model 10 - Sentiment Analysis with wordnet query expansion")
-    sentiment_model = SentimentAwareIRModel(NoSpellCorrection, ThesaurusQueryExpansion(HF_CACHE), idx, SentimentRanker(REVIEWS_INDEX))
-    sentiment_model.set_autoexpansion(True)
-    bench.test_and_print(sentiment_model)
+    print(f"Report saved to {output}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,165 @@
+"""
+This module contains bounded, in-memory caches shared by the services of the project,
+as well as lazily computed values and pools of warm index searchers.
+"""
+from __future__ import annotations
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generic, Hashable, Iterator, List, TypeVar, TYPE_CHECKING
+from placerank import config
+import threading
+import time
+
+if TYPE_CHECKING:
+    from whoosh.index import Index
+    from whoosh.scoring import WeightingModel
+    from whoosh.searching import Searcher
+
+
+class LRUCache:
+    """
+    A thread-safe mapping of bounded size that evicts the least recently used entry when full.
+    If a `ttl` (in seconds) is given, entries older than that are treated as missing.
+    Lookups are counted as hits or misses, for monitoring purposes.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 128, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            timestamp, value = self._entries.get(key, (None, self._MISSING))
+
+            if value is not self._MISSING and self.ttl is not None and time.monotonic() - timestamp > self.ttl:
+                del self._entries[key]
+                value = self._MISSING
+
+            if value is self._MISSING:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """
+    A value computed by `factory` on first access - typically a costly model to load - and then kept.
+    Concurrent first accesses wait for a single computation.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: T = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> T:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self._factory()
+                    self._loaded = True
+
+        return self._value
+
+
+class SearcherPool:
+    """
+    Warm Whoosh searchers of `index`, leased to one search at a time. Opening a searcher reads the segment
+    metadata of the index, and closing it drops its caches of term statistics and filters: the pool keeps
+    up to `maxsize` idle searchers per weighting type, and refreshes a searcher only when it is leased
+    after the index generation changed.
+    Searchers fix their weighting model when created, so the one of the search is set on each lease.
+    Idle searchers are grouped by the type of their weighting model, which the cached inverse document
+    frequencies depend on.
+    """
+
+    def __init__(self, index: Index, maxsize: int = config.SEARCHER_POOL_SIZE):
+        self.index = index
+        self.maxsize = maxsize
+        self._idle: Dict[type, List[Searcher]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, weighting: WeightingModel = None) -> Iterator[Searcher]:
+        """
+        A searcher of the latest generation of the index scoring with `weighting`, BM25F by default,
+        returned to the pool when the block exits.
+        """
+        from whoosh.scoring import BM25F
+
+        weighting = weighting or BM25F()
+
+        with self._lock:
+            idle = self._idle.get(type(weighting))
+            searcher = idle.pop() if idle else None
+
+        searcher = searcher.refresh() if searcher else self.index.searcher(weighting = weighting)
+        searcher.weighting = weighting
+
+        for subsearcher, _ in searcher.subsearchers or ():
+            subsearcher.weighting = weighting
+
+        try:
+            yield searcher
+        finally:
+            self._release(searcher)
+
+    def _release(self, searcher: Searcher) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(type(searcher.weighting), [])
+
+            if len(idle) < self.maxsize:
+                idle.append(searcher)
+                return
+
+        searcher.close()
+
+    def close(self) -> None:
+        """
+        Close the idle searchers.
+        """
+        with self._lock:
+            searchers = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+
+        for searcher in searchers:
+            searcher.close()
+
+    def __len__(self) -> int:
+        return sum(len(idle) for idle in self._idle.values())
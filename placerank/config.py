@@ -1,12 +1,27 @@
 DATASET_URL = 'http://data.insideairbnb.com/united-states/ny/new-york-city/2024-01-05/data/listings.csv.gz'
 REVIEWS_URL = 'http://data.insideairbnb.com/united-states/ny/new-york-city/2024-01-05/data/reviews.csv.gz'
 BATCH_SIZE = 10000
+GOEMOTIONS_MAX_TOKENS = 8192
+RERANK_DEPTH = 500
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 600
+SEARCHER_POOL_SIZE = 8
+EMBEDDINGS_CACHE_SIZE = 4096
 INDEX_DIR = 'index/'
-REVIEWS_INDEX = "datasets/ny_reviews.pickle"
-REVIEWS_DB = "datasets/reviewsdb.pickle"
+DENSE_INDEX_DIR = 'index/dense'
+DENSE_DTYPE = 'float32'  # Or 'float16', to halve the size of the dense index
+HYBRID_DEPTH = 100  # Candidates retrieved by each side of hybrid search
+DENSE_NPROBE = 16  # Clusters scanned by approximate dense search: more is slower, with higher recall
+REVIEWS_INDEX = "datasets/ny_reviews.npz"
+REVIEWS_DB = "datasets/reviewsdb"
+REVIEWS_CHECKPOINT_DIR = "datasets/reviews_checkpoint"
 DATASET_CACHE_FILE = "datasets/ny_listings.csv"
+LISTINGS_DB = "datasets/listings.sqlite"
 REVIEWS_CACHE_FILE = "datasets/reviews.csv"
 HF_MODEL_MASKING = 'bert-large-uncased-whole-word-masking'
 HF_MODEL_ENCODING = 'bert-base-uncased'
+HF_MODEL_GOEMOTIONS = 'monologg/bert-base-cased-goemotions-original'
+INFERENCE_BACKEND = 'fp32'  # One of placerank.inference.BACKENDS: 'int8' quantizes the BERT models for CPU
 HF_CACHE = 'hf_cache'
+SYNONYM_TABLE = 'datasets/synonyms.npz'
 HELP_FILENAME = "HELP.txt"
\ No newline at end of file
@@ -1,8 +1,10 @@
-from placerank.sentiment import GoEmotionsClassifier
-from placerank.views import InsideAirbnbSchema, DocumentView, ReviewView
+from __future__ import annotations
+from placerank.sentiment import GoEmotionsClassifier, ParallelGoEmotionsClassifier
+from placerank.views import InsideAirbnbSchema, DocumentView, ReviewView, ReviewsIndex
+from placerank.cache import Lazy
 import placerank.config as config
 from whoosh.fields import Schema, TEXT, ID
-from whoosh.index import create_in, Index
+from whoosh.index import create_in, open_dir, Index
 from whoosh.analysis import Analyzer
 import requests
 import io
@@ -11,53 +13,160 @@ import sys
 import csv
 import gzip
 import sys
+from array import array
 from collections import defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import heapq
 import pickle
+import shutil
+import sqlite3
+import threading
 from operator import itemgetter
 from itertools import islice
 from datetime import datetime
 import pydash
 import argparse
+import numpy as np
 from placerank.config import *
 
-def download_dataset(url: str, storage: io.StringIO) -> io.StringIO:
+@contextmanager
+def download_dataset(url: str) -> Iterator[io.TextIOBase]:
     """
-    Download data of InsideAirbnb and unpacks it in memory.
+    Stream data of InsideAirbnb and unpack it on the fly.
+    The response body is read in chunks and decompressed incrementally, so that just a bounded
+    window of the dataset is kept in memory, regardless of its size.
     """
 
-    r = requests.get(url)
-    
-    if not r.ok:
-        raise ConnectionError(f"Error retrieving the dataset source. Server returned status code {r.status}")
+    with requests.get(url, stream = True) as r:
+        if not r.ok:
+            raise ConnectionError(f"Error retrieving the dataset source. Server returned status code {r.status_code}")
+
+        r.raw.decode_content = True  # Undo transfer encodings only, the archive is decompressed below
+
+        with gzip.GzipFile(mode = "rb", fileobj = r.raw) as gz, io.TextIOWrapper(gz, encoding = "utf-8", newline = "") as text:
+            yield text
 
-    with io.BytesIO(r.content) as gz_response:
-        with gzip.GzipFile(mode="r:gz", fileobj=gz_response) as gz:
-            for line in gz:
-                storage.write(line.decode()) #TODO: reimplement using less memory
 
-    storage.seek(0)
-    return storage
+def _tee(lines: Iterable[str], fp: io.TextIOBase) -> Iterator[str]:
+    """
+    Write each line to `fp` while passing it through.
+    """
+    for line in lines:
+        fp.write(line)
+        yield line
 
 
-def get_dataset(local_file: str, remote_url: str, storage: io.StringIO) -> io.StringIO:
+@contextmanager
+def get_dataset(local_file: str, remote_url: str) -> Iterator[Iterable[str]]:
     """
-    Proxy method that writes the downloaded content to file, if passed; otherwise it keeps an in-memory representation of the dataset.
-    If just a local file is passed, the dataset is loaded from that file.
+    Proxy context manager that yields the lines of the dataset, one at a time.
+    If a remote url is passed the dataset is streamed from there and, if a local file is passed too,
+    each line is also written to it as it goes by. The local file is replaced only once the whole dataset has been read.
+    If just a local file is passed, the dataset is read from that file.
     """
     if not remote_url and (not local_file or not os.path.isfile(local_file)):
         raise RuntimeError("Invalid local file and no remote source. Please provide at least one valid argument.")
 
     if remote_url:
-        storage = download_dataset(remote_url, storage)
+        with download_dataset(remote_url) as stream:
+            if not local_file:
+                yield stream
+                return
 
-        if local_file:
-            with open(local_file, 'w') as f:
-                print(storage.getvalue(), file = f)
-        return storage
-    
-    with open(local_file, 'r') as f:
-        storage = io.StringIO(f.read())
-    return storage
+            partial_file = local_file + ".part"
+
+            try:
+                with open(partial_file, "w", encoding = "utf-8", newline = "") as cache:
+                    lines = _tee(stream, cache)
+                    yield lines
+
+                    for _ in lines: pass  # Drain whatever the consumer left behind, so that the cache is complete
+            except BaseException:
+                os.remove(partial_file)
+                raise
+
+            os.replace(partial_file, local_file)
+        return
+
+    with open(local_file, "r", encoding = "utf-8", newline = "") as f:
+        yield f
+
+
+class ListingStore:
+    """
+    Persistent store of listings keyed by their id, backed by a SQLite table.
+    It is filled at index time and serves `DocumentView` lookups through the primary key
+    index, without ever loading the dataset.
+    """
+
+    def __init__(self, filename: str):
+        self._conn = sqlite3.connect(filename, check_same_thread = False)
+        self._lock = threading.Lock()
+        self._columns = ", ".join(DocumentView._fields)
+        self._placeholders = ", ".join("?" * len(DocumentView._fields))
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS listings ({self._columns}, PRIMARY KEY (id))"
+            )
+
+    def __enter__(self) -> ListingStore:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        self.close()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM listings")
+
+    def put(self, record: dict):
+        """
+        Insert or replace a listing. Changes are visible to other connections after `commit`.
+        """
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO listings ({self._columns}) VALUES ({self._placeholders})",
+                [record[k] for k in DocumentView._fields]
+            )
+
+    def delete(self, id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM listings WHERE id = ?", (id, ))
+
+    def get(self, id: str) -> Optional[DocumentView]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._columns} FROM listings WHERE id = ?", (str(id), )).fetchone()
+
+        return DocumentView(*row) if row else None
+
+    def __iter__(self) -> Iterator[DocumentView]:
+        """
+        All the listings, by id, fetched a chunk at a time.
+        """
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT {self._columns} FROM listings ORDER BY id")
+
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+
+            if not rows:
+                break
+
+            yield from (DocumentView(*row) for row in rows)
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
 
 def create_index(index_dir: str, schema: Schema) -> Index:
@@ -69,32 +178,85 @@ def create_index(index_dir: str, schema: Schema) -> Index:
     return ix
 
 
-def populate_index(index_dir: str, local_file: str, remote_url: str = None, analyzer: Analyzer = None):
+def populate_index(index_dir: str, local_file: str, remote_url: str = None, analyzer: Analyzer = None, jobs: int = 1, listings_db: str = LISTINGS_DB):
     """
     This function builds the inverted index of the provided dataset.
     If no local_file is passed, the dataset is downloaded straight from the remote_url.
     If just the local_file is passed, the dataset is loaded from there.
-    If both argumetns are passed, the dataset is downloaded and stored in the local_file, then the
+    If both argumetns are passed, the dataset is downloaded and stored in the local_file while the
     inverted index is created.
+    Rows are streamed straight into the index writer, so the dataset is never held in memory as a whole.
+    If `jobs` is greater than one, rows are sharded across a pool of processes, each of them analyzing its
+    share and writing its own segment; segments are then merged into a single one in `index_dir`.
+    Listings are also stored in the `ListingStore` at `listings_db`, which serves them by id.
     """
     schema = InsideAirbnbSchema(analyzer)
     ix = create_index(index_dir, schema)
+    writer_args = {"procs": jobs, "multisegment": False} if jobs > 1 else {}
+
+    with get_dataset(local_file, remote_url) as lines, ix.writer(**writer_args) as writer, ListingStore(listings_db) as store:
+        store.clear()
+
+        for row in csv.DictReader(lines):
+            writer.add_document(**schema.get_document_logic_view(row), digest = schema.get_document_digest(row))
+            store.put(row)
+
+    ix.close()
+
+
+def refresh_index(index_dir: str, local_file: str, remote_url: str = None, listings_db: str = LISTINGS_DB) -> Tuple[int, int, int]:
+    """
+    This function brings an existing inverted index up to date with a new snapshot of the dataset.
+    Arguments are the same of `populate_index`.
+    Listings are matched by their unique id: new ones are added, the ones whose content digest
+    changed are re-analyzed and updated, delisted ones are deleted. Untouched listings cost no analysis.
+    The listing store is upserted with every listing, since it also serves fields outside the digest.
+    Changing the analyzer still requires a full rebuild through `populate_index`.
+    Returns the number of added, updated and deleted documents.
+    """
+    ix = open_dir(index_dir)
+    schema = ix.schema
+
+    if "digest" not in schema:
+        raise RuntimeError("The index does not store content digests. Please rebuild it with populate_index.")
+
+    with ix.searcher() as s:
+        indexed = {fields["id"]: fields.get("digest") for fields in s.all_stored_fields()}
+
+    added = updated = 0
+    seen = set()
+
+    with get_dataset(local_file, remote_url) as lines, ix.writer() as writer, ListingStore(listings_db) as store:
+        for row in csv.DictReader(lines):
+            digest = schema.get_document_digest(row)
+            seen.add(row["id"])
 
-    with io.StringIO() as ram_storage, ix.writer() as writer:
-        storage = get_dataset(local_file, remote_url, ram_storage)
+            if row["id"] not in indexed:
+                writer.add_document(**schema.get_document_logic_view(row), digest = digest)
+                added += 1
+            elif indexed[row["id"]] != digest:
+                writer.update_document(**schema.get_document_logic_view(row), digest = digest)
+                updated += 1
 
-        dset = csv.DictReader(storage)
+            store.put(row)
 
-        for row in dset:
-            writer.add_document(**schema.get_document_logic_view(row))
+        delisted = indexed.keys() - seen
+
+        for id in delisted:
+            writer.delete_by_term("id", id)
+            store.delete(id)
 
     ix.close()
+    return (added, updated, len(delisted))
 
 
 class ReviewsDict:
     """
     Represent a Reviews file as a dictionary. Decodes CSV, preprocess text for BERT compatibility and
     filter the latest 10 reviews for each listing.
+    The file is read in a single pass: a bounded min-heap per listing keeps just its latest reviews,
+    so memory grows with the number of listings, not with the number of reviews.
+    Reviews are yielded by listing and by date, both descending.
     """
 
     LAST_REVIEWS = 10
@@ -102,32 +264,39 @@ class ReviewsDict:
     def __init__(self, fp):
         self.csvdictreader = csv.DictReader(fp)
         self.__iterobj = None
-        self.__last_id = 0
-        self.__counter = 0
 
     @staticmethod
     def __todate(s: str):
         return datetime.strptime(s, "%Y-%m-%d")
-    
-    def __filter_first(self, row):
-        if row.get("listing_id") != self.__last_id:
-            self.__last_id = row.get("listing_id")
-            self.__counter = 0
 
-        if self.__counter < self.LAST_REVIEWS:
-            self.__counter += 1
-            
-            return True
+    def __select_latest(self) -> Dict[int, list]:
+        latest = defaultdict(list)
+
+        for position, row in enumerate(self.csvdictreader):
+            row = row | {"listing_id": int(row["listing_id"]), "id": int(row["id"]), "date": ReviewsDict.__todate(row["date"])}
+            heap = latest[row["listing_id"]]
+            # Same-day reviews are ranked by position in the file, as a stable sort would do
+            entry = (row["date"], -position, row)
+
+            if len(heap) < self.LAST_REVIEWS:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+
+        return latest
 
-        return False
+    def __generate(self):
+        latest = self.__select_latest()
+
+        for listing_id in sorted(latest, reverse = True):
+            for _, _, row in sorted(latest.pop(listing_id), key = itemgetter(0, 1), reverse = True):
+                yield row
     
     def __iter__(self):
         if self.__iterobj:
             return self.__iterobj
-        
-        converted_types = map(lambda x: x | {"listing_id": int(x["listing_id"]), "id": int(x["id"]), "date": ReviewsDict.__todate(x["date"])}, self.csvdictreader)
-        sortedreviews = sorted(converted_types, key=lambda x: (x.get("listing_id"), x.get("date") ), reverse=True)
-        self.__iterobj = filter(self.__filter_first, sortedreviews)
+
+        self.__iterobj = self.__generate()
 
         return self.__iterobj
 
@@ -139,37 +308,79 @@ def preprocess_comment(comment: str) -> str:
     return comment[:500]
 
 
-def build_reviews_index(link: str = REVIEWS_URL):
-    reviews_index = defaultdict(list)
-
-    sent = GoEmotionsClassifier()
-
-    with io.StringIO() as storage, open(config.REVIEWS_INDEX, "bw") as fp:
-        get_dataset(config.REVIEWS_CACHE_FILE, link, storage)
+def _checkpoint_file(checkpoint_dir: str, batch: int) -> str:
+    return os.path.join(checkpoint_dir, f"batch-{batch:06d}.npz")
 
-        print("Downloaded dataset")
 
-        dset = ReviewsDict(storage)
-
-        while True:
-            nextbatch = [r for r in islice(dset, BATCH_SIZE)]
-            
-            if not nextbatch:
-                break
+def _load_checkpoint(checkpoint_dir: str, batch: int, rows: List[dict]) -> Optional[dict]:
+    """
+    Columns of a classified batch, if it was checkpointed from the very same reviews.
+    """
+    try:
+        with np.load(_checkpoint_file(checkpoint_dir, batch)) as checkpoint:
+            columns = dict(checkpoint)
+    except (OSError, ValueError):
+        return None
+
+    if not np.array_equal(columns["review_ids"], [r["id"] for r in rows]):
+        return None
+    return columns
+
+
+def _save_checkpoint(checkpoint_dir: str, batch: int, rows: List[dict], sentiments: List[List[dict]]) -> None:
+    filename = _checkpoint_file(checkpoint_dir, batch)
+
+    with open(filename + ".part", "wb") as fp:
+        np.savez(
+            fp,
+            listing_ids = np.array([r["listing_id"] for r in rows], dtype = np.int64),
+            review_ids = np.array([r["id"] for r in rows], dtype = np.int64),
+            dates = np.array([r["date"].toordinal() for r in rows], dtype = np.int32),
+            labels = np.array([[ReviewsIndex.LABELS_MAP[s.get("label")] for s in sentiment] for sentiment in sentiments], dtype = np.uint8),
+            scores = np.array([[s.get("score") for s in sentiment] for sentiment in sentiments], dtype = np.float32),
+        )
 
-            comments = map(preprocess_comment, map(itemgetter("comments"), nextbatch))
-            sentiments = sent.classify_texts(list(comments))
+    os.replace(filename + ".part", filename)
 
-            for row, sentiment in zip(nextbatch, sentiments):
-                print(row.get("id"))
-                reviews_index[int(row["listing_id"])].append((int(row["id"]), row["date"], sentiment))
 
-        pickle.dump(reviews_index, fp)
+def build_reviews_index(link: str = REVIEWS_URL, jobs: int = 1, checkpoint_dir: str = config.REVIEWS_CHECKPOINT_DIR):
+    """
+    Classify the latest reviews of each listing and save them as the reviews index.
+    Every batch of `BATCH_SIZE` reviews is checkpointed to `checkpoint_dir` once classified, so an
+    interrupted build resumes from the first missing batch; checkpoints are removed at the end.
+    With `jobs` > 1 batches are classified by as many CPU processes.
+    """
+    os.makedirs(checkpoint_dir, exist_ok = True)
+
+    with get_dataset(config.REVIEWS_CACHE_FILE, link) as lines:
+        reviews = iter(ReviewsDict(lines))
+        batches = list(iter(lambda: list(islice(reviews, BATCH_SIZE)), []))
+
+    pending = [n for n, rows in enumerate(batches) if _load_checkpoint(checkpoint_dir, n, rows) is None]
+    print(f"{len(batches) - len(pending)} of {len(batches)} batches already classified")
+
+    texts = ([preprocess_comment(r["comments"]) for r in batches[n]] for n in pending)
+    classifier = ParallelGoEmotionsClassifier(jobs) if jobs > 1 else GoEmotionsClassifier()
+
+    try:
+        for n, sentiments in zip(pending, classifier.classify_batches(texts)):
+            _save_checkpoint(checkpoint_dir, n, batches[n], sentiments)
+            print(f"Batch {n + 1}/{len(batches)} classified")
+    finally:
+        if jobs > 1:
+            classifier.close()
+
+    checkpoints = [_load_checkpoint(checkpoint_dir, n, rows) for n, rows in enumerate(batches)]
+    ReviewsIndex.save(
+        config.REVIEWS_INDEX,
+        *(np.concatenate([c[column] for c in checkpoints]) for column in ("listing_ids", "review_ids", "dates", "labels", "scores"))
+    )
+    shutil.rmtree(checkpoint_dir)
 
 
 def load_page(local_dataset: str, id: str) -> DocumentView:
     """
-    TODO: optimize using in-memory dataset
+    Linear scan of the local dataset. Prefer `ListingStore.get`, which does not read the dataset at all.
     """
     with open(local_dataset, 'r') as listings:
         return DocumentView.from_record(
@@ -180,23 +391,118 @@ def load_page(local_dataset: str, id: str) -> DocumentView:
         )
 
 
+class ColumnarReviews(Mapping):
+    """
+    Read-only mapping from listing ids to their reviews, backed by memory-mapped columns in `path`:
+     - `listings.npy`, `starts.npy`, `ends.npy`: sorted listing ids and the range of their reviews
+     - `ids.npy`, `dates.npy`, `text_offsets.npy`: review ids, dates as day ordinals and bounds of their comments
+     - `comments.bin`: UTF-8 blob of all the comments
+    Nothing is decoded until a listing is looked up, and then just its reviews are.
+    """
+
+    COLUMNS = ("listings", "starts", "ends", "ids", "dates", "text_offsets")
+
+    def __init__(self, path: str):
+        for column in self.COLUMNS:
+            setattr(self, column, np.load(os.path.join(path, f"{column}.npy"), mmap_mode = "r"))
+
+        blob = os.path.join(path, "comments.bin")
+        self.comments = np.memmap(blob, dtype = np.uint8, mode = "r") if os.path.getsize(blob) else np.empty(0, dtype = np.uint8)
+
+    @staticmethod
+    def write(reviews: Iterable[dict], path: str):
+        """
+        Store reviews in columnar format. Reviews of the same listing must be contiguous.
+        """
+        os.makedirs(path, exist_ok = True)
+
+        listings, starts, ends = array("q"), array("q"), array("q")
+        ids, dates, text_offsets = array("q"), array("i"), array("q", [0])
+
+        with open(os.path.join(path, "comments.bin"), "wb") as blob:
+            for row in reviews:
+                if not listings or listings[-1] != row["listing_id"]:
+                    if listings: ends.append(len(ids))
+                    listings.append(row["listing_id"])
+                    starts.append(len(ids))
+
+                ids.append(row["id"])
+                dates.append(row["date"].toordinal())
+                text_offsets.append(text_offsets[-1] + blob.write(row["comments"].encode()))
+
+        if listings: ends.append(len(ids))
+
+        order = np.argsort(np.array(listings, dtype = np.int64), kind = "stable")
+        columns = {
+            "listings": np.array(listings, dtype = np.int64)[order],
+            "starts": np.array(starts, dtype = np.int64)[order],
+            "ends": np.array(ends, dtype = np.int64)[order],
+            "ids": np.array(ids, dtype = np.int64),
+            "dates": np.array(dates, dtype = np.int32),
+            "text_offsets": np.array(text_offsets, dtype = np.int64),
+        }
+
+        for column, values in columns.items():
+            np.save(os.path.join(path, f"{column}.npy"), values)
+
+    def _range(self, listing_id) -> Optional[range]:
+        i = int(np.searchsorted(self.listings, listing_id))
+
+        if i < len(self.listings) and self.listings[i] == listing_id:
+            return range(int(self.starts[i]), int(self.ends[i]))
+        return None
+
+    def __getitem__(self, listing_id) -> List[ReviewView]:
+        """
+        Reviews of a listing, latest first. Listings without reviews map to an empty list.
+        """
+        reviews = self._range(int(listing_id)) or range(0)
+
+        return [
+            ReviewView(
+                int(self.ids[r]),
+                datetime.fromordinal(int(self.dates[r])),
+                bytes(self.comments[self.text_offsets[r]:self.text_offsets[r + 1]]).decode()
+            )
+            for r in reviews
+        ]
+
+    def __contains__(self, listing_id) -> bool:
+        return self._range(int(listing_id)) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(l) for l in self.listings)
+
+    def __len__(self) -> int:
+        return len(self.listings)
+
+
 class ReviewsDatabase:
+    """
+    Reviews of each listing, stored in columnar format and memory-mapped: resident memory stays
+    close to zero and just the reviews that are looked up get decoded.
+    The database is opened on first use, or ahead of it by `warm_up`.
+    """
+
     def __init__(self, filename):
-        if ".pickle" in filename:
-            with open(filename, "rb") as fp:
-                self.db = pickle.load(fp)
+        """
+        `filename` is either the path of a columnar database or a reviews CSV, from which
+        a database is built at `config.REVIEWS_DB`.
+        """
+        if filename.endswith(".csv"):
+            with open(filename, "r", encoding = "utf-8", newline = "") as fp:
+                ColumnarReviews.write(ReviewsDict(fp), config.REVIEWS_DB)
 
-        else:
-            self.db = defaultdict(list)
+            filename = config.REVIEWS_DB
 
-            with open(filename, "r") as fp:
-                reader = ReviewsDict(fp)
-                for row in reader:
-                    self.db[row.get("listing_id")].append(ReviewView.from_record(row))
+        self._db = Lazy(lambda: ColumnarReviews(filename))
 
-            with open(config.REVIEWS_DB, "wb") as fp:
-                pickle.dump(self.db, fp)
+    @property
+    def db(self) -> ColumnarReviews:
+        return self._db.get()
 
+    def warm_up(self) -> None:
+        self._db.get()
 
 
 def main():
@@ -205,17 +511,34 @@ def main():
         description = "Convenience module to download and index a InsideAirBnb dataset"
     )
 
-    parser.add_argument('-i', '--index-directory', required = True, help = 'Directory in which the index is created')
-    parser.add_argument('-l', '---local-file', required = True, help = 'Path to local file. Download destination if dataset is not there, otherwise used as a local cache')
+    parser.add_argument('-i', '--index-directory', default = config.INDEX_DIR, help = 'Directory in which the index is created. Defaults to INDEX_DIR.')
+    parser.add_argument('-l', '---local-file', help = 'Path to local file. Download destination if dataset is not there, otherwise used as a local cache. The index is built, or refreshed, only if given.')
     parser.add_argument('-r', '--remote-url', help = 'Source URL from which the dataset is downloaded. Omit it if you want to use the local copy on your disk.')
-    parser.add_argument('-j', '--review-index', action = "store_true", help = 'Build the reviews index.')
+    parser.add_argument('-j', '--review-index', action = "store_true", help = 'Build the reviews index. Without -l, the index is left as it is.')
+    parser.add_argument('-u', '--refresh', action = "store_true", help = 'Incrementally update an existing index instead of rebuilding it.')
+    parser.add_argument('-d', '--dense', action = "store_true", help = 'Embed the listings of LISTINGS_DB for dense retrieval, in the dense/ subdirectory of the index directory. Without -l, the index is left as it is.')
+    parser.add_argument('--jobs', type = int, default = 1, metavar = 'N', help = 'Number of processes used to analyze and index listings, or to classify reviews. Defaults to 1.')
     
     args = parser.parse_args(sys.argv[1:])  # Exclude module itself from arguments list
 
+    if not (args.local_file or args.dense or args.review_index):
+        parser.error("the following arguments are required: -l/---local-file, unless just building the reviews index with -j or embedding listings with -d")
+
+    if args.refresh and not args.local_file:
+        parser.error("-u/--refresh requires -l/---local-file")
+
     if args.review_index:
-        build_reviews_index(config.REVIEWS_URL)
+        build_reviews_index(config.REVIEWS_URL, jobs = args.jobs)
+
+    if args.local_file and args.refresh:
+        added, updated, deleted = refresh_index(args.index_directory, args.local_file, args.remote_url)
+        print(f"Index refreshed: {added} added, {updated} updated, {deleted} deleted")
+    elif args.local_file:
+        populate_index(args.index_directory, args.local_file, args.remote_url, jobs = args.jobs)
 
-    populate_index(args.index_directory, args.local_file, args.remote_url)
+    if args.dense:
+        from placerank.dense import build_dense_index
+        build_dense_index(os.path.join(args.index_directory, "dense"))
 
 
 if __name__ == "__main__":
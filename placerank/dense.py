@@ -0,0 +1,252 @@
+"""
+Dense retrieval. Listings are embedded by BERT at index time and stored as a memory-mapped matrix
+of unit vectors; queries are answered by vectorized top-k cosine similarity against it, either
+exhaustively or approximately through an inverted file index of clustered vectors.
+"""
+from __future__ import annotations
+from typing import List, Optional, Sequence, Tuple, TYPE_CHECKING
+from placerank.cache import Lazy
+from placerank.inference import optimize
+from placerank.query_expansion import mean_pooled_embeddings
+import placerank.config as config
+import numpy as np
+import math
+import os
+import re
+
+if TYPE_CHECKING:
+    from placerank.views import DocumentView
+
+
+HTML_TAGS = re.compile(r"<[^>]+>")
+
+
+def listing_text(listing: DocumentView) -> str:
+    """
+    The text a listing is embedded from: its name, description and neighborhood overview.
+    """
+    return ". ".join(HTML_TAGS.sub(" ", text) for text in (listing.name, listing.description, listing.neighborhood_overview) if text)
+
+
+class DenseEncoder:
+    """
+    Encoder of listings and queries: mean-pooled BERT embeddings, normalized to unit length.
+    The model is loaded on first use, or ahead of it by `warm_up`.
+    """
+
+    def __init__(self, hf_cache: str = config.HF_CACHE, model_name: str = config.HF_MODEL_ENCODING):
+        self._models = Lazy(lambda: self._load_models(model_name, hf_cache))
+
+    @staticmethod
+    def _load_models(model_name: str, hf_cache: str):
+        from transformers import BertTokenizer, BertModel
+
+        tokenizer = BertTokenizer.from_pretrained(model_name, cache_dir = hf_cache)
+        encoder = optimize(BertModel.from_pretrained(model_name, cache_dir = hf_cache).eval())
+        return (tokenizer, encoder)
+
+    def warm_up(self) -> None:
+        self._models.get()
+
+    def encode(self, texts: Sequence[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Unit embeddings of `texts`, as the rows of a float32 matrix.
+        Texts are batched by length, so that short ones are not padded up to long ones.
+        """
+        tokenizer, encoder = self._models.get()
+        embeddings = np.zeros((len(texts), encoder.config.hidden_size), dtype = np.float32)
+        order = sorted(range(len(texts)), key = lambda i: len(texts[i]))
+
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            embeddings[batch] = mean_pooled_embeddings(tokenizer, encoder, [texts[i] for i in batch]).float().numpy()
+
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis = 1, keepdims = True), 1e-12)
+
+
+class DenseIndex:
+    """
+    Embeddings of the listings, stored in `path` as memory-mapped columns:
+     - `vectors.npy`: unit embeddings, one row per listing, either float32 or float16
+     - `ids.npy`: listing ids
+     - `room_types.npy`, `room_type_names.npy`: room type of each listing, coded as the position of its name
+    """
+
+    SCORING_CHUNK = 8192  # Rows of float16 vectors widened to float32 at a time
+
+    def __init__(self, path: str):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode = "r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode = "r")
+        self.room_types = np.load(os.path.join(path, "room_types.npy"), mmap_mode = "r")
+        self.room_type_names: List[str] = np.load(os.path.join(path, "room_type_names.npy")).tolist()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def write(path: str, ids: Sequence[str], room_types: Sequence[str], vectors: np.ndarray, dtype: str = config.DENSE_DTYPE):
+        os.makedirs(path, exist_ok = True)
+        names, codes = np.unique(np.array(room_types, dtype = str), return_inverse = True)
+
+        np.save(os.path.join(path, "vectors.npy"), vectors.astype(dtype))
+        np.save(os.path.join(path, "ids.npy"), np.array(ids, dtype = str))
+        np.save(os.path.join(path, "room_types.npy"), codes.astype(np.uint8))
+        np.save(os.path.join(path, "room_type_names.npy"), names)
+
+    def room_type_mask(self, room_type: str) -> Optional[np.ndarray]:
+        """
+        Listings whose room type holds all the words of `room_type`, as the lexical filter on the
+        keyword field matches them. None if there is nothing to filter.
+        """
+        words = set(room_type.lower().split())
+
+        if not words:
+            return None
+
+        matching = [code for code, name in enumerate(self.room_type_names) if words <= set(name.lower().split())]
+        return np.isin(self.room_types, matching)
+
+    def scores(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Cosine similarity between `query`, a unit vector, and the listings at `rows` - all of them by default.
+        """
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        query = query.astype(np.float32)
+
+        if vectors.dtype == np.float32:
+            return vectors @ query
+
+        scores = np.empty(len(vectors), dtype = np.float32)
+
+        for start in range(0, len(vectors), self.SCORING_CHUNK):
+            scores[start:start + self.SCORING_CHUNK] = vectors[start:start + self.SCORING_CHUNK].astype(np.float32) @ query
+
+        return scores
+
+    @staticmethod
+    def top_k(rows: np.ndarray, scores: np.ndarray, k: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The `k` best scored rows - all of them if `k` is None - best first.
+        """
+        if k is not None and k < len(scores):
+            best = np.argpartition(-scores, k)[:k] if k > 0 else np.empty(0, dtype = np.int64)
+        else:
+            best = np.arange(len(scores))
+
+        best = best[np.argsort(-scores[best], kind = "stable")]
+        return rows[best], scores[best]
+
+    def search(self, query: np.ndarray, k: Optional[int] = 10, mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Rows and scores of the `k` listings most similar to `query`, restricted to `mask` if given,
+        along with the number of listings searched.
+        """
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(len(self))
+        scores = self.scores(query, rows if mask is not None else None)
+
+        return (*self.top_k(rows, scores, k), len(rows))
+
+
+class IVFIndex:
+    """
+    Inverted file index over the vectors of a `DenseIndex`, for approximate search. Listings are clustered
+    by spherical k-means and a query scores just the listings of the `nprobe` clusters closest to it:
+    the more clusters are probed, the higher both recall and latency.
+    Stored along with the dense index, as memory-mapped columns:
+     - `ivf_centroids.npy`: unit centroids of the clusters
+     - `ivf_rows.npy`, `ivf_offsets.npy`: rows of the dense index grouped by cluster and the bounds of each group
+    """
+
+    ASSIGNMENT_CHUNK = 8192
+
+    def __init__(self, dense_index: DenseIndex):
+        self.dense_index = dense_index
+        self.centroids = np.load(os.path.join(dense_index.path, "ivf_centroids.npy"), mmap_mode = "r")
+        self.rows = np.load(os.path.join(dense_index.path, "ivf_rows.npy"), mmap_mode = "r")
+        self.offsets = np.load(os.path.join(dense_index.path, "ivf_offsets.npy"), mmap_mode = "r")
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """
+        Closest centroid of each vector.
+        """
+        return np.concatenate([
+            np.argmax(vectors[start:start + IVFIndex.ASSIGNMENT_CHUNK].astype(np.float32) @ centroids.T, axis = 1)
+            for start in range(0, len(vectors), IVFIndex.ASSIGNMENT_CHUNK)
+        ])
+
+    @staticmethod
+    def write(path: str, vectors: np.ndarray, nlist: int = None, iterations: int = 10, seed: int = 0):
+        """
+        Cluster `vectors` in `nlist` lists - by default four times the square root of their number - and store them at `path`.
+        Centroids are trained on a sample of 64 vectors per list at most.
+        """
+        rng = np.random.default_rng(seed)
+        nlist = min(nlist or max(1, int(4 * math.sqrt(len(vectors)))), len(vectors))
+
+        sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), 64 * nlist), replace = False))].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace = False)]
+
+        for _ in range(iterations):
+            assignment = IVFIndex._assign(sample, centroids)
+            counts = np.bincount(assignment, minlength = nlist)
+            filled = counts > 0
+
+            starts = np.cumsum(counts) - counts
+            centroids[filled] = np.add.reduceat(sample[np.argsort(assignment, kind = "stable")], starts[filled])
+            centroids[~filled] = sample[rng.choice(len(sample), np.count_nonzero(~filled))]  # Reseed empty clusters
+            centroids /= np.maximum(np.linalg.norm(centroids, axis = 1, keepdims = True), 1e-12)
+
+        assignment = IVFIndex._assign(vectors, centroids)
+        counts = np.bincount(assignment, minlength = nlist)
+
+        np.save(os.path.join(path, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(path, "ivf_rows.npy"), np.argsort(assignment, kind = "stable"))
+        np.save(os.path.join(path, "ivf_offsets.npy"), np.concatenate(([0], np.cumsum(counts))))
+
+    def search(self, query: np.ndarray, k: Optional[int] = 10, mask: np.ndarray = None, nprobe: int = config.DENSE_NPROBE) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Approximate `DenseIndex.search`, scoring the listings of the `nprobe` clusters closest to `query`.
+        Further clusters are probed while fewer than `k` listings pass `mask`.
+        """
+        probed, candidates = [], 0
+
+        for cluster in np.argsort(-(self.centroids @ query.astype(np.float32))):
+            rows = self.rows[self.offsets[cluster]:self.offsets[cluster + 1]]
+
+            if mask is not None:
+                rows = rows[mask[rows]]
+
+            probed.append(rows)
+            candidates += len(rows)
+
+            if len(probed) >= nprobe and (k is None or candidates >= k):
+                break
+
+        rows = np.concatenate(probed)
+        scores = self.dense_index.scores(query, rows)
+
+        return (*DenseIndex.top_k(rows, scores, k), len(rows))
+
+
+def build_dense_index(path: str = config.DENSE_INDEX_DIR, listings_db: str = config.LISTINGS_DB, encoder: DenseEncoder = None, batch_size: int = 64, nlist: int = None):
+    """
+    Embed all the listings of the `ListingStore` at `listings_db` and store them as a `DenseIndex` at `path`,
+    along with its `IVFIndex` of `nlist` clusters.
+    Run it after `populate_index` or `refresh_index`, which fill the store.
+    """
+    from placerank.dataset import ListingStore
+
+    encoder = encoder or DenseEncoder()
+
+    with ListingStore(listings_db) as store:
+        listings = list(store)
+
+    vectors = encoder.encode([listing_text(l) for l in listings], batch_size)
+    DenseIndex.write(path, [l.id for l in listings], [l.room_type for l in listings], vectors)
+    IVFIndex.write(path, vectors, nlist)
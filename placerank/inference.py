@@ -0,0 +1,129 @@
+"""
+Inference backends for the BERT models of the project, selected by `config.INFERENCE_BACKEND`:
+ - `fp32`: models as released, in full precision
+ - `int8`: torch dynamic quantization of the linear layers, for CPU-only hosts
+
+Run this module to validate a backend against fp32 and measure its speedup on the models in use.
+"""
+from __future__ import annotations
+from typing import Dict, List, TYPE_CHECKING
+import placerank.config as config
+import argparse
+import copy
+import sys
+import time
+import warnings
+
+if TYPE_CHECKING:
+    import torch
+
+
+BACKENDS = ("fp32", "int8")
+
+SAMPLE_SENTENCES = [
+    "cozy apartment near central park",
+    "quiet room with a view, close to the subway",
+    "spacious loft in williamsburg with a large kitchen and a rooftop terrace",
+    "the host was lovely and the place was spotless, would definitely stay again",
+]
+
+
+def optimize(model: torch.nn.Module, backend: str = None, device: str = "cpu") -> torch.nn.Module:
+    """
+    The model converted for `backend`, which defaults to `config.INFERENCE_BACKEND`.
+    Quantized kernels run on CPU only: on other devices the model is returned as it is.
+    """
+    import torch
+
+    backend = backend or config.INFERENCE_BACKEND
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+
+    if backend == "fp32":
+        return model
+
+    if device != "cpu":
+        warnings.warn(f"The {backend} backend runs on CPU only, keeping fp32 on {device}")
+        return model
+
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype = torch.qint8)
+
+
+def compare(reference: torch.nn.Module, candidate: torch.nn.Module, inputs: Dict[str, torch.Tensor]) -> Dict[str, float]:
+    """
+    Drift of the first output of `candidate` from `reference` on the same inputs: the largest
+    absolute difference and the lowest cosine similarity between output vectors.
+    """
+    import torch
+
+    with torch.inference_mode():
+        expected = reference(**inputs)[0].float()
+        actual = candidate(**inputs)[0].float()
+
+    return {
+        "max_abs_diff": (expected - actual).abs().max().item(),
+        "min_cosine": torch.nn.functional.cosine_similarity(expected, actual, dim = -1).min().item(),
+    }
+
+
+def latency(model: torch.nn.Module, inputs: Dict[str, torch.Tensor], repeat: int = 10) -> float:
+    """
+    Median latency in seconds of a forward pass on `inputs`.
+    """
+    import torch
+
+    timings = []
+
+    with torch.inference_mode():
+        model(**inputs)  # Warm up
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(**inputs)
+            timings.append(time.perf_counter() - start)
+
+    return sorted(timings)[len(timings) // 2]
+
+
+def validate(model: torch.nn.Module, tokenizer, backend: str, sentences: List[str] = SAMPLE_SENTENCES, repeat: int = 10) -> Dict[str, float]:
+    """
+    Drift and speedup of `backend` over fp32 for `model`, which is left untouched.
+    """
+    inputs = tokenizer(sentences, padding = True, truncation = True, return_tensors = "pt")
+    candidate = optimize(copy.deepcopy(model), backend)
+
+    report = compare(model, candidate, inputs)
+    report["speedup"] = latency(model, inputs, repeat) / latency(candidate, inputs, repeat)
+
+    return report
+
+
+def main():
+    from transformers import BertTokenizer, BertModel, BertForMaskedLM, AutoModelForSequenceClassification
+
+    parser = argparse.ArgumentParser(
+        prog = "Placerank inference backends",
+        description = "Validate an inference backend against fp32 on the models in use"
+    )
+
+    parser.add_argument('-b', '--backend', default = "int8", choices = BACKENDS, help = 'Backend to validate. Defaults to int8.')
+    parser.add_argument('-n', '--repeat', type = int, default = 10, help = 'Forward passes timed per model. Defaults to 10.')
+    parser.add_argument('--hf-cache', default = config.HF_CACHE, help = 'HuggingFace cache directory.')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    models = {
+        config.HF_MODEL_ENCODING: lambda: BertModel.from_pretrained(config.HF_MODEL_ENCODING, cache_dir = args.hf_cache),
+        config.HF_MODEL_MASKING: lambda: BertForMaskedLM.from_pretrained(config.HF_MODEL_MASKING, cache_dir = args.hf_cache),
+        config.HF_MODEL_GOEMOTIONS: lambda: AutoModelForSequenceClassification.from_pretrained(config.HF_MODEL_GOEMOTIONS, num_labels = 28),
+    }
+
+    for name, load in models.items():
+        tokenizer = BertTokenizer.from_pretrained(name, cache_dir = args.hf_cache)
+        report = validate(load().eval(), tokenizer, args.backend, repeat = args.repeat)
+        print(f"{name}: max abs diff {report['max_abs_diff']:.4f}, min cosine {report['min_cosine']:.4f}, speedup {report['speedup']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
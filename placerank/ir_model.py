@@ -21,19 +21,23 @@ This module contains the definition of a `IRModel`, aka a search engine stack:
 from __future__ import annotations
 from abc import ABC, abstractmethod
 import math
+import time
 import pydash
+import numpy as np
 from enum import auto
 from operator import itemgetter
 from whoosh.scoring import WeightingModel
 from whoosh.index import Index
 from whoosh.scoring import BM25F
-from whoosh.query import Term
+from whoosh.query import Term, Query
+from whoosh.searching import Searcher
 from whoosh import qparser
-from typing import List, Tuple, Type
+from typing import Dict, List, Tuple, Type
 
-from placerank.views import ResultView, QueryView, ReviewsIndex
+from placerank.views import ResultView, QueryView, SearchResult, ReviewsIndex
 from placerank.query_expansion import QueryExpansionService
 from placerank.sentiment import BaseSentimentWeightingModel
+from placerank.cache import LRUCache, SearcherPool
 from placerank import config
 
 class IRModel(ABC):
@@ -43,14 +47,28 @@ class IRModel(ABC):
         query_expander: QueryExpansionService,
         index: Index,
         weighting_model: WeightingModel = BM25F(),
-        connector: str = 'AND'
+        connector: str = 'AND',
+        rerank_depth: int = None,
+        cache_size: int = config.SEARCH_CACHE_SIZE,
+        cache_ttl: float = config.SEARCH_CACHE_TTL
     ):
+        """
+        If `rerank_depth` is given and `weighting_model` is sentiment-aware, ranking happens in two stages:
+        plain BM25F retrieves the top `rerank_depth` candidates, then sentiment re-scores them all at once.
+        Otherwise sentiment is applied to every matching document while Whoosh scores it.
+        Results of the last `cache_size` searches are kept for `cache_ttl` seconds; pass 0 to disable caching.
+        Searches lease warm searchers of `index` from a pool shared by concurrent requests.
+        """
         self.spell_corrector = spell_corrector(self)
         self.query_expander = query_expander
         self.index = index
+        self.searchers = SearcherPool(index)
         self.weighting_model = weighting_model
         self._autoexpansion = False
         self.connector = connector
+        self.rerank_depth = rerank_depth
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+        self._cache_generation = None
 
     def get_query_parser(self, query: QueryView) -> qparser.QueryParser:
         return qparser.MultifieldParser([f.name.lower() for f in query.search_fields], self.index.schema)
@@ -58,44 +76,180 @@ class IRModel(ABC):
     def set_autoexpansion(self, autoexpansion: bool):
         self._autoexpansion = autoexpansion
 
-    def search(self, query: QueryView, **kwargs) -> Tuple(List[ResultView], int):
+    def warm_up(self) -> None:
+        """
+        Load the models behind the services of the stack ahead of the first search, which would load them otherwise.
+        """
+        self.query_expander.warm_up()
+
+        with self.searchers.lease(self.weighting_model):
+            pass
+
         if isinstance(self.weighting_model, BaseSentimentWeightingModel):
-            self.weighting_model.set_user_sentiment(query.sentiment_tags)
+            self.weighting_model.warm_up()
+
+    def close(self) -> None:
+        """
+        Release the searchers kept warm for the model.
+        """
+        self.searchers.close()
+
+    def search(self, query: QueryView, **kwargs) -> SearchResult:
+        """
+        Return results along with the query expansion, the spelling suggestion and the time spent in each stage,
+        all computed once. `result[0]` and `result[1]` are still the results and the total hits.
+        Results are served from the cache when the same normalized query was already answered
+        by the same configuration of the model, on the same generation of the index.
+        The autoexpansion state is read once, so a search toggled meanwhile is cached under the state it used.
+        """
+        autoexpansion = self._autoexpansion
+
+        if self.cache is None:
+            return self._search(query, autoexpansion, **kwargs)
+
+        generation = self.index.latest_generation()
+
+        if generation != self._cache_generation:  # The index changed: whatever is cached is stale
+            self.cache.clear()
+            self._cache_generation = generation
+
+        try:
+            key = (self._normalize(query), autoexpansion, self.weighting_model, generation, frozenset(kwargs.items()))
+            hash(key)
+        except TypeError:  # Unhashable search arguments can't be cached
+            return self._search(query, autoexpansion, **kwargs)
+
+        if (result := self.cache.get(key)) is None:
+            result = self._search(query, autoexpansion, **kwargs)
+            self.cache.put(key, result)
+
+        return result
+
+    @staticmethod
+    def _normalize(query: QueryView) -> QueryView:
+        return query._replace(
+            textual_query = ' '.join(query.textual_query.split()),
+            room_type = query.room_type.strip().lower(),
+            sentiment_tags = ' '.join(query.sentiment_tags.split())
+        )
+
+    def _search(self, query: QueryView, autoexpansion: bool, **kwargs) -> SearchResult:
+        stopwatch = Stopwatch()
+        expanded_query, parsed_query, room_type, weighting = self._prepare(query, autoexpansion, stopwatch)
+
+        with self.searchers.lease(self._lexical_weighting(weighting)) as s:
+            results, tot = self._lexical_search(s, weighting, parsed_query, room_type, **kwargs)
+            stopwatch.lap("search")
+
+            corrected_query = self.spell_corrector.correct(query, s)
+            stopwatch.lap("correction")
+
+        return SearchResult(results, tot, expanded_query, corrected_query, stopwatch.timings())
+
+    def _prepare(self, query: QueryView, autoexpansion: bool, stopwatch: Stopwatch) -> Tuple[str, Query, Query, WeightingModel]:
+        """
+        Expand the query and parse it, along with its room type filter. Also returns the weighting model
+        of this search: a sentiment-aware one is copied with the sentiment of the query, so that the model
+        can serve concurrent searches.
+        """
+        weighting = self.weighting_model
+
+        if isinstance(weighting, BaseSentimentWeightingModel):
+            weighting = weighting.with_user_sentiment(query.sentiment_tags)
 
         expanded_query = self.query_expander.expand(query.textual_query, connector = self.connector)
+        stopwatch.lap("expansion")
 
         parser = qparser.QueryParser('room_type', self.index.schema)
         room_type = parser.parse(query.room_type) if query.room_type else None
 
         parser = self.get_query_parser(query)
-        query = parser.parse(expanded_query if self._autoexpansion else query.textual_query)
+        parsed_query = parser.parse(expanded_query if autoexpansion else query.textual_query)
+        stopwatch.lap("parsing")
+
+        return (expanded_query, parsed_query, room_type, weighting)
+
+    def _lexical_weighting(self, weighting: WeightingModel) -> WeightingModel:
+        return weighting.lexical_model() if self._reranks(weighting) else weighting
+
+    def _lexical_search(self, searcher: Searcher, weighting: WeightingModel, query: Query, room_type: Query, **kwargs) -> Tuple[List[ResultView], int]:
+        """
+        Results of a searcher opened with `_lexical_weighting`, re-ranked by sentiment if needed, and the total hits.
+        """
+        if self._reranks(weighting):
+            return self._search_and_rerank(searcher, weighting, query, room_type, **kwargs)
+
+        hits = searcher.search(query, filter = room_type, **kwargs)
+        return ([ResultView.from_hit(hit.fields(), hit.score) for hit in hits], len(hits))
+
+    def _reranks(self, weighting: WeightingModel) -> bool:
+        return (
+            bool(self.rerank_depth)
+            and isinstance(weighting, BaseSentimentWeightingModel)
+            and weighting.has_user_sentiment()
+        )
+
+    def _search_and_rerank(self, searcher: Searcher, weighting: BaseSentimentWeightingModel, query: Query, room_type: Query, limit: int = 10, **kwargs) -> Tuple(List[ResultView], int):
+        """
+        Two-stage ranking: lexical retrieval of a bounded candidate set, followed by a vectorized
+        sentiment re-scoring of the whole set.
+        """
+        depth = max(self.rerank_depth, limit) if limit else None
 
-        with self.index.searcher(weighting = self.weighting_model) as s:
-            hits = s.search(query, filter = room_type, **kwargs)
-            tot = len(hits)
-            results = [ResultView(**dict(hit) | {"score": hit.score}) for hit in hits]
+        hits = searcher.search(query, filter = room_type, limit = depth, **kwargs)
+        tot = len(hits)
+        candidates = [hit.fields() for hit in hits]
+        scores = np.fromiter((hit.score for hit in hits), dtype = np.float32, count = len(candidates))
+
+        scores = weighting.rerank([c["id"] for c in candidates], scores)
+        ranking = np.argsort(-scores, kind = "stable")[:limit]
+        results = [ResultView.from_hit(candidates[i], float(scores[i])) for i in ranking]
 
         return (results, tot)
 
 
+class Stopwatch:
+    """
+    Measures the time spent in consecutive stages of a computation.
+    """
+
+    def __init__(self):
+        self._start = self._last = time.perf_counter()
+        self._laps: Dict[str, float] = {}
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self._laps[stage] = now - self._last
+        self._last = now
+
+    def timings(self) -> Dict[str, float]:
+        return self._laps | {"total": self._last - self._start}
+
+
 class SpellCorrectionService(ABC):
     def __init__(self, ir_model: IRModel):
         self._ir_model = ir_model
 
     @abstractmethod
-    def correct(self, query: QueryView) -> str:
+    def correct(self, query: QueryView, searcher: Searcher = None) -> str:
+        """
+        Return the corrected textual query. If a searcher is passed, it is used instead of opening a new one.
+        """
         ...
 
 class NoSpellCorrection(SpellCorrectionService):
-    def correct(self, query: QueryView) -> str:
+    def correct(self, query: QueryView, searcher: Searcher = None) -> str:
         return query.textual_query
 
 class WhooshSpellCorrection(SpellCorrectionService):
-    def correct(self, query: QueryView) -> str:
+    def correct(self, query: QueryView, searcher: Searcher = None) -> str:
         parser = self._ir_model.get_query_parser(query)
         parsed_query = parser.parse(query.textual_query)
+
+        if searcher:
+            return searcher.correct_query(parsed_query, query.textual_query).string
         
-        with self._ir_model.index.searcher() as s:
+        with self._ir_model.searchers.lease() as s:
             corrected_query = s.correct_query(parsed_query, query.textual_query)
 
         return corrected_query.string
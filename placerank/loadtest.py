@@ -0,0 +1,239 @@
+"""
+Load testing of the models under concurrent traffic. Queries - replayed from a log or synthesized
+from the vocabulary of the index - are sent to a model by several threads, either as fast as the model
+answers or at a given arrival rate, and latencies are collected in histograms.
+Stepping the arrival rate up finds the saturation throughput of a model, i.e. the highest rate it sustains.
+"""
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence
+from placerank.ir_model import IRModel
+from placerank.views import QueryView, SearchFields, GOEMOTIONS_LABELS
+from placerank.query_expansion import spelling_vocabulary
+from placerank.benchmark import VARIANTS, SharedServices, peak_rss_mb
+from placerank.config import INDEX_DIR, HF_CACHE
+from whoosh.index import Index
+from collections import Counter
+from datetime import datetime
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import numpy as np
+
+
+SEARCH_FIELDS = SearchFields.DESCRIPTION | SearchFields.NEIGHBORHOOD_OVERVIEW | SearchFields.NAME
+
+# Upper bounds of the latency histogram buckets, in seconds: from 1 ms to about 65 s, doubling
+HISTOGRAM_BUCKETS = tuple(0.001 * 2**i for i in range(17))
+
+
+def load_query_log(path: str) -> List[QueryView]:
+    """
+    Queries of a log with one query per line: its text, optionally followed by a tab and a room type,
+    and by another tab and space separated sentiment tags.
+    """
+    queries = []
+
+    with open(path) as fp:
+        for line in fp:
+            text, room_type, sentiment_tags = (line.rstrip("\n").split("\t") + ["", ""])[:3]
+
+            if text.strip():
+                queries.append(QueryView(text, SEARCH_FIELDS, room_type, sentiment_tags))
+
+    return queries
+
+
+def synthesize_queries(index: Index, n: int = 1000, max_terms: int = 3, room_type_ratio: float = 0.2, sentiment_ratio: float = 0.2, seed: int = 0) -> List[QueryView]:
+    """
+    `n` queries of up to `max_terms` words drawn from the spelling vocabulary of the index. Some of them
+    filter by a room type term or carry sentiment tags, according to the given ratios.
+    """
+    rng = random.Random(seed)
+    vocabulary = spelling_vocabulary(index)
+
+    with index.reader() as reader:
+        room_types = [term.decode() for term in reader.lexicon("room_type")]
+
+    return [
+        QueryView(
+            " ".join(rng.sample(vocabulary, rng.randint(1, min(max_terms, len(vocabulary))))),
+            SEARCH_FIELDS,
+            rng.choice(room_types) if room_types and rng.random() < room_type_ratio else "",
+            " ".join(rng.sample(GOEMOTIONS_LABELS, rng.randint(1, 2))) if rng.random() < sentiment_ratio else ""
+        )
+        for _ in range(n)
+    ]
+
+
+def latency_histogram(latencies: Sequence[float]) -> List[Dict[str, float]]:
+    """
+    Number of latencies up to each bucket bound, and beyond the last one (bound None).
+    """
+    counts = np.bincount(np.searchsorted(HISTOGRAM_BUCKETS, latencies), minlength = len(HISTOGRAM_BUCKETS) + 1)
+    return [{"le": le, "count": int(c)} for le, c in zip((*HISTOGRAM_BUCKETS, None), counts)]
+
+
+def run_load(model: IRModel, queries: Sequence[QueryView], concurrency: int = 1, rate: float = None, duration: float = 10.0, seed: int = 0, grace: float = 1.0) -> dict:
+    """
+    Send `queries`, cyclically, to `model` from `concurrency` threads for `duration` seconds.
+    With a `rate`, arrivals are a Poisson process of `rate` queries per second (open loop): latencies are
+    measured from the scheduled arrival, so they include the time a query waits for a free thread.
+    Arrivals still waiting `grace` seconds after the end are dropped, so that a rate above capacity does not
+    stretch the run until its backlog drains.
+    Without, each thread sends its next query as soon as the previous one is answered (closed loop).
+    """
+    rng = np.random.default_rng(seed)
+    arrivals = np.cumsum(rng.exponential(1 / rate, int(rate * duration * 1.5) + 1)) if rate else None
+    taken = itertools.count()
+    lock = threading.Lock()
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors: List[Counter] = [Counter() for _ in range(concurrency)]
+
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def worker(n: int):
+        while True:
+            with lock:
+                i = next(taken)
+
+            if arrivals is not None:
+                if i >= len(arrivals) or start + arrivals[i] >= deadline:
+                    return
+                if time.perf_counter() >= deadline + grace:
+                    return  # The backlog left is counted as dropped
+                scheduled = start + arrivals[i]
+                time.sleep(max(0, scheduled - time.perf_counter()))
+            else:
+                scheduled = time.perf_counter()
+                if scheduled >= deadline:
+                    return
+
+            try:
+                model.search(queries[i % len(queries)])
+                latencies[n].append(time.perf_counter() - scheduled)
+            except Exception as e:
+                errors[n][type(e).__name__] += 1
+
+    threads = [threading.Thread(target = worker, args = (n, ), daemon = True) for n in range(concurrency)]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    elapsed = time.perf_counter() - start
+    completed = [l for worker_latencies in latencies for l in worker_latencies]
+    percentiles = np.percentile(completed, (50, 95, 99)).tolist() if completed else [None] * 3
+    offered = int(np.count_nonzero(arrivals < duration)) if rate else None
+    failed = sum(sum(e.values()) for e in errors)
+
+    return {
+        "concurrency": concurrency,
+        "rate": rate,
+        "offered_rate": offered / duration if rate else None,
+        "duration": elapsed,
+        "completed": len(completed),
+        "errors": dict(sum(errors, Counter())),
+        "dropped": offered - len(completed) - failed if rate else None,
+        "throughput": len(completed) / elapsed,
+        "latency": dict(zip(("p50", "p95", "p99"), percentiles)) | {"max": max(completed, default = None)},
+        "histogram": latency_histogram(completed),
+    }
+
+
+def find_saturation(model: IRModel, queries: Sequence[QueryView], concurrency: int, rates: Sequence[float], duration: float = 10.0, slo: float = None, grace: float = 1.0) -> dict:
+    """
+    Step the arrival rate through `rates`, in increasing order, until the model stops sustaining it: its
+    throughput - including the time to drain the queries still waiting at the end - falls below 95% of the
+    offered rate, it fails or drops some query or, given a `slo` in seconds, its p99 latency exceeds it.
+    The saturation rate is the highest one sustained, 0 if none.
+    """
+    runs, saturation = [], 0
+
+    for rate in sorted(rates):
+        run = run_load(model, queries, concurrency, rate, duration, grace = grace)
+        runs.append(run)
+
+        sustained = (
+            run["throughput"] >= 0.95 * run["offered_rate"]
+            and not run["errors"]
+            and not run["dropped"]
+            and (slo is None or (run["latency"]["p99"] is not None and run["latency"]["p99"] <= slo))
+        )
+
+        if not sustained:
+            break
+        saturation = rate
+
+    return {"concurrency": concurrency, "saturation_rate": saturation, "slo": slo, "runs": runs}
+
+
+def print_histogram(histogram: List[Dict[str, float]], width: int = 40):
+    peak = max((b["count"] for b in histogram), default = 0) or 1
+
+    for b in histogram:
+        if b["count"]:
+            label = f"<= {b['le'] * 1000:.0f} ms" if b["le"] is not None else "beyond"
+            print(f"\t\t{label:>12} {'#' * round(width * b['count'] / peak)} {b['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog = "Placerank load test",
+        description = "Measure latency and saturation throughput of model variants under concurrent traffic"
+    )
+
+    parser.add_argument('-v', '--variants', nargs = '+', choices = VARIANTS.keys(), default = ["base"], metavar = 'VARIANT', help = f'Variants to load, among: {", ".join(VARIANTS)}. Defaults to base.')
+    parser.add_argument('-c', '--concurrency', nargs = '+', type = int, default = [1, 4], help = 'Numbers of concurrent clients to test. Defaults to 1 and 4.')
+    parser.add_argument('-r', '--rates', nargs = '+', type = float, help = 'Arrival rates, in queries per second, stepped up to find the saturation throughput. Without, clients are closed loop.')
+    parser.add_argument('-d', '--duration', type = float, default = 10.0, help = 'Seconds each load level lasts. Defaults to 10.')
+    parser.add_argument('-g', '--grace', type = float, default = 1.0, help = 'Seconds after each load level during which queries still waiting are served, the others are dropped. Defaults to 1.')
+    parser.add_argument('--slo', type = float, help = 'Maximum p99 latency, in seconds, for a rate to count as sustained.')
+    parser.add_argument('-l', '--log', help = 'Query log to replay. Without, queries are synthesized from the index vocabulary.')
+    parser.add_argument('-n', '--queries', type = int, default = 1000, help = 'Number of queries synthesized. Defaults to 1000.')
+    parser.add_argument('-o', '--output', help = 'Path of the JSON report. Defaults to validation/loadtest-<timestamp>.json.')
+
+    args = parser.parse_args(sys.argv[1:])
+    output = args.output or f"validation/loadtest-{datetime.now():%Y%m%d-%H%M%S}.json"
+
+    services = SharedServices(INDEX_DIR, HF_CACHE)
+    queries = load_query_log(args.log) if args.log else synthesize_queries(services.index, args.queries)
+    reports = []
+
+    for name in args.variants:
+        model = VARIANTS[name].build(services)
+        model.warm_up()
+
+        for query in queries[:10]:  # First searches pay for lazy initializations
+            model.search(query)
+
+        print(f"{name} - {VARIANTS[name].description}")
+
+        for concurrency in args.concurrency:
+            if args.rates:
+                report = find_saturation(model, queries, concurrency, args.rates, args.duration, args.slo, args.grace)
+                last = report["runs"][-1]
+                print(f"\t{concurrency} clients: saturation at {report['saturation_rate']} QPS")
+            else:
+                report = last = run_load(model, queries, concurrency, duration = args.duration)
+                print(f"\t{concurrency} clients: {report['throughput']:.1f} QPS")
+
+            print(f"\t\tp50 {last['latency']['p50'] or 0:.3f} s, p95 {last['latency']['p95'] or 0:.3f} s, p99 {last['latency']['p99'] or 0:.3f} s, errors {last['errors'] or 'none'}" + (f", dropped {last['dropped']}" if last["dropped"] is not None else ""))
+            print_histogram(last["histogram"])
+            reports.append({"variant": name} | report)
+
+        model.close()
+
+    with open(output, "w") as fp:
+        json.dump({"date": datetime.now().isoformat(), "queries": len(queries), "peak_rss_mb": peak_rss_mb(), "runs": reports}, fp, indent = 2)
+
+    print(f"Report saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,18 @@ from whoosh.index import Index, open_dir
 from whoosh.query import *
 from whoosh.qparser import QueryParser, syntax
 from whoosh.qparser.plugins import MultifieldPlugin
-from typing import Type, Tuple, List
+from typing import Dict, Type, Tuple, List
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import numpy as np
 
 from placerank.views import *
 from placerank.ir_model import *
 from placerank.query_expansion import *
 from placerank.sentiment import *
-from placerank.config import HF_CACHE, INDEX_DIR, REVIEWS_INDEX
+from placerank.dense import DenseEncoder, DenseIndex, IVFIndex
+from placerank.cache import Lazy
+from placerank.config import HF_CACHE, INDEX_DIR, REVIEWS_INDEX, DENSE_INDEX_DIR, HYBRID_DEPTH, SEARCHER_POOL_SIZE
 
 
 class MultifieldUnionPlugin(MultifieldPlugin):
@@ -30,6 +35,166 @@ class UnionIRModel(IRModel):
         return p
 
 
+class DenseIRModel(IRModel):
+    """
+    Dense retrieval: listings are ranked by the cosine similarity between their embedding, precomputed
+    by `placerank.dense.build_dense_index`, and the one of the query. Every listing is a candidate, so
+    the total is the number of listings searched.
+    Name, description and neighborhood overview are embedded together, whatever the search fields are.
+    If `nprobe` is given, search is approximate: just the listings of the `nprobe` closest clusters
+    of the `IVFIndex` are scored.
+    """
+
+    def __init__(self, spell_corrector, query_expander, index, *args, dense_index: str = DENSE_INDEX_DIR, encoder: DenseEncoder = None, nprobe: int = None, **kwargs):
+        super().__init__(spell_corrector, query_expander, index, *args, **kwargs)
+        self.encoder = encoder or DenseEncoder()
+        self.nprobe = nprobe
+        self._dense_index = Lazy(lambda: DenseIndex(dense_index))
+        self._ivf_index = Lazy(lambda: IVFIndex(self.dense_index))
+
+    dense_index = property(lambda self: self._dense_index.get())
+    ivf_index = property(lambda self: self._ivf_index.get())
+
+    def warm_up(self) -> None:
+        super().warm_up()
+        self.encoder.warm_up()
+        self._dense_index.get()
+
+        if self.nprobe:
+            self._ivf_index.get()
+
+    def _nearest(self, vector: np.ndarray, limit: int, mask: np.ndarray = None, nprobe: int = None) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Exact search, or approximate if `nprobe` is given.
+        """
+        if nprobe:
+            return self.ivf_index.search(vector, limit, mask, nprobe)
+        return self.dense_index.search(vector, limit, mask)
+
+    def _dense_search(self, query: QueryView, text: str, limit: int) -> Tuple[List[str], np.ndarray, int]:
+        """
+        Ids and scores of the `limit` listings closest to `text`, along with the number of listings searched.
+        """
+        vector = self.encoder.encode([text])[0]
+        rows, scores, tot = self._nearest(vector, limit, self.dense_index.room_type_mask(query.room_type), self.nprobe)
+
+        return ([str(self.dense_index.ids[r]) for r in rows], scores, tot)
+
+    def _search(self, query: QueryView, autoexpansion: bool, limit: int = 10, **kwargs) -> SearchResult:
+        stopwatch = Stopwatch()
+
+        expanded_query = self.query_expander.expand(query.textual_query, connector = self.connector)
+        stopwatch.lap("expansion")
+
+        ids, scores, tot = self._dense_search(query, expanded_query if autoexpansion else query.textual_query, limit)
+        stopwatch.lap("search")
+
+        with self.searchers.lease() as s:
+            results = [
+                ResultView.from_hit(fields, float(score))
+                for fields, score in zip((s.document(id = id) for id in ids), scores)
+                if fields  # Listings embedded but no longer indexed
+            ]
+            stopwatch.lap("fetch")
+
+            corrected_query = self.spell_corrector.correct(query, s)
+            stopwatch.lap("correction")
+
+        return SearchResult(results, tot, expanded_query, corrected_query, stopwatch.timings())
+
+
+class HybridIRModel(UnionIRModel, DenseIRModel):
+    """
+    Hybrid retrieval: the lexical search - terms in OR, weighted by `weighting_model` - and the dense one
+    run concurrently, each one capped at `depth` candidates, then their rankings are fused by:
+     - `rrf`: reciprocal rank fusion, the sum of 1 / (`rrf_k` + rank) over the rankings a listing is in
+     - `linear`: `alpha` times the min-max normalized dense score plus 1 - `alpha` times the normalized lexical one
+    The room type filters both sides. The total is the number of distinct candidates.
+    The dense side runs on the calling thread, the lexical one on a pool of `workers` threads shared by
+    concurrent searches.
+    """
+
+    FUSIONS = ("rrf", "linear")
+
+    def __init__(self, spell_corrector, query_expander, index, *args, fusion: str = "rrf", depth: int = HYBRID_DEPTH, alpha: float = 0.5, rrf_k: int = 60, workers: int = SEARCHER_POOL_SIZE, **kwargs):
+        if fusion not in self.FUSIONS:
+            raise ValueError(f"Unknown fusion {fusion!r}, expected one of {', '.join(self.FUSIONS)}")
+
+        super().__init__(spell_corrector, query_expander, index, *args, **kwargs)
+        self.fusion = fusion
+        self.depth = depth
+        self.alpha = alpha
+        self.rrf_k = rrf_k
+        self._lexical_executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "lexical-search")
+
+    def close(self) -> None:
+        self._lexical_executor.shutdown()
+        super().close()
+
+    def _fuse_rrf(self, rankings: List[List[str]]) -> Dict[str, float]:
+        fused: Dict[str, float] = {}
+
+        for ranking in rankings:
+            for rank, id in enumerate(ranking, start = 1):
+                fused[id] = fused.get(id, 0) + 1 / (self.rrf_k + rank)
+
+        return fused
+
+    def _fuse_linear(self, lexical: Dict[str, float], dense: Dict[str, float]) -> Dict[str, float]:
+        def normalized(scores: Dict[str, float]) -> Dict[str, float]:
+            if not scores:
+                return {}
+
+            low, high = min(scores.values()), max(scores.values())
+            return {id: (s - low) / (high - low) if high > low else 1.0 for id, s in scores.items()}
+
+        lexical, dense = normalized(lexical), normalized(dense)
+        return {
+            id: (1 - self.alpha) * lexical.get(id, 0) + self.alpha * dense.get(id, 0)
+            for id in lexical | dense
+        }
+
+    def _search(self, query: QueryView, autoexpansion: bool, limit: int = 10, **kwargs) -> SearchResult:
+        stopwatch = Stopwatch()
+        expanded_query, parsed_query, room_type, weighting = self._prepare(query, autoexpansion, stopwatch)
+        depth = max(self.depth, limit) if limit else self.depth
+
+        lexical_search = self._lexical_executor.submit(self._lexical_candidates, weighting, parsed_query, room_type, depth, **kwargs)
+
+        dense_ids, dense_scores, _ = self._dense_search(query, expanded_query if autoexpansion else query.textual_query, depth)
+        stopwatch.lap("dense")
+
+        lexical = lexical_search.result()
+        stopwatch.lap("lexical")
+
+        with self.searchers.lease() as s:
+            if self.fusion == "rrf":
+                fused = self._fuse_rrf([[r.id for r in lexical], dense_ids])
+            else:
+                fused = self._fuse_linear({r.id: r.score for r in lexical}, dict(zip(dense_ids, dense_scores.tolist())))
+
+            ranking = sorted(fused.items(), key = itemgetter(1), reverse = True)[:limit]
+            fields = {r.id: r._asdict() for r in lexical}
+            results = [
+                ResultView.from_hit(hit, score)
+                for id, score in ranking
+                if (hit := fields.get(id) or s.document(id = id))  # Dense candidates no longer indexed are dropped
+            ]
+            stopwatch.lap("fusion")
+
+            corrected_query = self.spell_corrector.correct(query, s)
+            stopwatch.lap("correction")
+
+        return SearchResult(results, len(fused), expanded_query, corrected_query, stopwatch.timings())
+
+    def _lexical_candidates(self, weighting: WeightingModel, query: Query, room_type: Query, depth: int, **kwargs) -> List[ResultView]:
+        """
+        Runs on the lexical pool.
+        """
+        with self.searchers.lease(self._lexical_weighting(weighting)) as s:
+            return self._lexical_search(s, weighting, query, room_type, limit = depth, **kwargs)[0]
+
+
 
 def main():
     idx = open_dir(INDEX_DIR)
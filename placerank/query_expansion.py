@@ -1,18 +1,244 @@
-import nltk, torch, pydash
-from typing import List
+"""
+Query expansion services. Heavy dependencies - torch, transformers and the models themselves -
+are imported and loaded on first use, so that importing this module is cheap.
+
+Run this module to compare the expansions of the synonym table with the contextual ones on the benchmark
+queries, and to recalibrate the threshold of its priors.
+"""
+from __future__ import annotations
+import nltk, pydash
+import functools
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TYPE_CHECKING
+from collections.abc import Mapping
 from operator import itemgetter
-from huggingface_hub import snapshot_download
 from nltk.corpus import wordnet as wn
-from transformers import BertTokenizer, BertModel, BertForMaskedLM, FillMaskPipeline
 from abc import ABC, abstractmethod
+from placerank.cache import LRUCache, Lazy
+from placerank.config import EMBEDDINGS_CACHE_SIZE, SYNONYM_TABLE, INDEX_DIR, HF_CACHE
+from placerank.inference import optimize
+import numpy as np
+import argparse
+import json
+import os
+import random
+import sys
+
+if TYPE_CHECKING:
+    import torch
+    from transformers import BertTokenizer, BertModel
+    from whoosh.index import Index
 
 
 def setup(repo_ids: List[str], cache_dir: str):
+    from huggingface_hub import snapshot_download
+
     for id in repo_ids:
         snapshot_download(repo_id = id, cache_dir = cache_dir)
     nltk.download("wordnet")
 
 
+def mean_pooled_embeddings(tokenizer: BertTokenizer, encoder: BertModel, sentences: List[str]) -> torch.Tensor:
+    """
+    Embed a batch of sentences in a single padded forward pass.
+    Each embedding is the mean of the last hidden states of the tokens of the sentence - [CLS] and [SEP]
+    included - computed under the attention mask, so that padding does not contribute.
+    """
+    import torch
+
+    batch = tokenizer(sentences, padding = True, truncation = True, return_tensors = 'pt')
+
+    with torch.no_grad():
+        hidden_states = encoder(**batch).last_hidden_state
+
+    mask = batch['attention_mask'].unsqueeze(-1).to(hidden_states.dtype)
+    return (hidden_states * mask).sum(dim = 1) / mask.sum(dim = 1)
+
+
+@functools.lru_cache(maxsize = 4096)
+def wordnet_candidates(token: str) -> Tuple[str, ...]:
+    """
+    WordNet lemmas of all the synsets of a token, excluding the token itself and its morphed versions.
+    """
+    return tuple(
+        pydash.chain([s.lemma_names() for s in wn.synsets(token)])
+            .flatten_deep()
+            .sorted_uniq()
+            .map(lambda c: c.replace('_', ' '))
+            .filter(lambda c: c.lower() != token.lower())  # Filters out duplicates
+            .filter(lambda c: wn.morphy(c.lower()) != wn.morphy(token.lower()))  # Filters out morphed version of the token
+            .value()
+    )
+
+
+class SynonymTable(Mapping):
+    """
+    Read-only mapping from terms to their WordNet candidates, each one with a context-free
+    similarity prior - the cosine similarity of the term and candidate embeddings - most similar first.
+    Stored as parallel arrays: sorted `terms`, `offsets` of their candidates, `candidates` and `priors`.
+    Priors do not compare with the contextual similarities of the same candidates, so they are filtered by
+    their own `threshold`, calibrated against the contextual expansions. None for uncalibrated tables.
+    """
+
+    def __init__(self, path: str):
+        with np.load(path) as table:
+            terms, offsets, candidates, priors = (table[k] for k in ("terms", "offsets", "candidates", "priors"))
+            self.threshold: Optional[float] = float(table["threshold"]) if "threshold" in table else None
+
+        candidates, priors = candidates.tolist(), priors.tolist()
+        self._entries: Dict[str, Tuple[Tuple[str, float], ...]] = {
+            term: tuple(zip(candidates[start:end], priors[start:end]))
+            for term, start, end in zip(terms.tolist(), offsets[:-1].tolist(), offsets[1:].tolist())
+        }
+
+    def __getitem__(self, term: str) -> Tuple[Tuple[str, float], ...]:
+        return self._entries[term]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def write(path: str, vocabulary: Iterable[str], tokenizer: BertTokenizer, encoder: BertModel, batch_size: int = 256):
+        """
+        Score the WordNet candidates of each term in `vocabulary` and store them at `path`.
+        Terms are embedded `batch_size` at a time, together with their candidates.
+        """
+        import torch
+
+        terms, offsets, candidates, priors = [], [0], [], []
+
+        for chunk in pydash.chunk(sorted(set(vocabulary)), batch_size):
+            chunk_candidates = [wordnet_candidates(term) for term in chunk]
+            sentences = list(dict.fromkeys(
+                pydash.flatten([[term, *term_candidates] for term, term_candidates in zip(chunk, chunk_candidates) if term_candidates])
+            ))
+            embeddings = dict(zip(sentences, mean_pooled_embeddings(tokenizer, encoder, sentences))) if sentences else {}
+
+            for term, term_candidates in zip(chunk, chunk_candidates):
+                if term_candidates:
+                    similarities = torch.nn.functional.cosine_similarity(
+                        torch.stack([embeddings[c] for c in term_candidates]), embeddings[term].unsqueeze(0), dim = 1
+                    ).tolist()
+                    scored = sorted(zip(term_candidates, similarities), key = itemgetter(1), reverse = True)
+                    candidates.extend(map(itemgetter(0), scored))
+                    priors.extend(map(itemgetter(1), scored))
+
+                terms.append(term)
+                offsets.append(len(candidates))
+
+        np.savez(
+            path,
+            terms = np.array(terms, dtype = str), offsets = np.array(offsets, dtype = np.int64),
+            candidates = np.array(candidates, dtype = str), priors = np.array(priors, dtype = np.float16)
+        )
+
+    @staticmethod
+    def write_threshold(path: str, threshold: float):
+        """
+        Store the calibrated `threshold` of the priors in the table at `path`.
+        """
+        with np.load(path) as table:
+            arrays = {k: table[k] for k in ("terms", "offsets", "candidates", "priors")}
+
+        np.savez(path, **arrays, threshold = np.float64(threshold))
+
+
+def spelling_vocabulary(index: Index) -> List[str]:
+    """
+    Words of the fields with spelling enabled, as spell correction sees them.
+    """
+    with index.reader() as reader:
+        return sorted({
+            word.decode()
+            for name, field in index.schema.items() if getattr(field, "spelling", False)
+            for word in reader.lexicon(field.spelling_fieldname(name) if field.separate_spelling() else name)
+        })
+
+
+def calibration_queries(vocabulary: List[str], benchmark_path: str = "validation/benchmark.json", n: int = 200, max_terms: int = 3, seed: int = 0) -> List[str]:
+    """
+    The benchmark queries, if any, followed by `n` queries of up to `max_terms` words drawn from `vocabulary`.
+    """
+    rng = random.Random(seed)
+    queries = []
+
+    if os.path.exists(benchmark_path):
+        with open(benchmark_path) as fp:
+            queries = [q["text"] for q in json.load(fp)]
+
+    return queries + [" ".join(rng.sample(vocabulary, rng.randint(1, min(max_terms, len(vocabulary))))) for _ in range(n if vocabulary else 0)]
+
+
+def contextual_expansions(contextual: ThesaurusQueryExpansion, table: SynonymTable, queries: List[str], max_results: int = 2, confidence_threshold: float = 0.9) -> List[Tuple[str, List[str]]]:
+    """
+    Expansions that `contextual`, a service without synonym table, gives to the tokens of `queries` found in `table`.
+    """
+    return [
+        (token, expansions)
+        for query in queries
+        for token, expansions in contextual.expansions(query, max_results, confidence_threshold)
+        if token in table
+    ]
+
+
+def prior_agreement(table: SynonymTable, expected: List[Tuple[str, List[str]]], threshold: float, max_results: int = 2) -> Dict[str, float]:
+    """
+    Agreement of the expansions looked up in `table` with priors above `threshold` with the `expected`
+    contextual ones: precision, recall and F1 over the expansions, and the ratio of tokens expanded alike.
+    """
+    hits = spurious = missed = alike = 0
+
+    for token, contextual in expected:
+        looked_up = set([c for c, prior in table[token] if prior > threshold][:max_results])
+        hits += len(looked_up & set(contextual))
+        spurious += len(looked_up - set(contextual))
+        missed += len(set(contextual) - looked_up)
+        alike += looked_up == set(contextual)
+
+    precision = hits / (hits + spurious) if hits + spurious else 1.0
+    recall = hits / (hits + missed) if hits + missed else 1.0
+
+    return {
+        "threshold": float(threshold),
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "alike": alike / len(expected) if expected else 1.0,
+        "tokens": len(expected),
+    }
+
+
+def calibrate_prior_threshold(table: SynonymTable, expected: List[Tuple[str, List[str]]], max_results: int = 2, thresholds: Iterable[float] = np.arange(0.5, 1.0, 0.01)) -> Dict[str, float]:
+    """
+    Agreement at the threshold of the priors that best reproduces the `expected` contextual expansions:
+    the highest F1, then the most tokens expanded alike, then the highest threshold.
+    """
+    return max(
+        (prior_agreement(table, expected, round(float(t), 2), max_results) for t in thresholds),
+        key = itemgetter("f1", "alike", "threshold")
+    )
+
+
+def build_synonym_table(index_dir: str, hf_cache: str, path: str = SYNONYM_TABLE):
+    """
+    Offline job that precomputes the synonym table of the spelling vocabulary of an index, then calibrates
+    the threshold of its priors against the contextual expansions of the calibration queries.
+    """
+    from whoosh.index import open_dir
+
+    qe = ThesaurusQueryExpansion(hf_cache)
+    vocabulary = spelling_vocabulary(open_dir(index_dir))
+    SynonymTable.write(path, vocabulary, qe.tokenizer, qe.encoder)
+
+    table = SynonymTable(path)
+    report = calibrate_prior_threshold(table, contextual_expansions(qe, table, calibration_queries(vocabulary)))
+    SynonymTable.write_threshold(path, report["threshold"])
+
+    return report
+
+
 class QueryExpansionService(ABC):
     """
     A class that implements a query expansion service.
@@ -26,6 +252,12 @@ class QueryExpansionService(ABC):
         """
         ...
 
+    def warm_up(self) -> None:
+        """
+        Load whatever the service needs ahead of its first use. Otherwise, services load lazily.
+        """
+        pass
+
 
 class NoQueryExpansion(QueryExpansionService):
     """
@@ -38,29 +270,60 @@ class NoQueryExpansion(QueryExpansionService):
 class ThesaurusQueryExpansion(QueryExpansionService):
     """
     A WordNet-based - aka thesaurus-based - query expansion service.
+    Candidate sentences of a query are embedded in a single batch; sentence embeddings and
+    WordNet lookups are memoized across queries.
+    Given a `synonym_table`, the path of a precomputed `SynonymTable`, terms found there are expanded
+    by their context-free priors with a lookup; just the other ones are scored in context by BERT.
+    Priors are filtered by the threshold calibrated for the table, which stands in for the default
+    `confidence_threshold`.
     """
-    def __init__(self, hf_cache: str):
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', cache_dir = hf_cache)
-        self.encoder = BertModel.from_pretrained('bert-base-uncased', output_hidden_states = True, cache_dir = hf_cache)
-        self.cos_sim = torch.nn.CosineSimilarity(dim  = 0)
+    def __init__(self, hf_cache: str, synonym_table: str = None):
+        self._tokenizer = Lazy(lambda: self._load_tokenizer(hf_cache))
+        self._encoder = Lazy(lambda: self._load_encoder(hf_cache))
+        self._synonym_table = Lazy(lambda: SynonymTable(synonym_table) if synonym_table else {})
+        self._embeddings = LRUCache(EMBEDDINGS_CACHE_SIZE)
+
+    @staticmethod
+    def _load_tokenizer(hf_cache: str):
+        from transformers import BertTokenizer
+        return BertTokenizer.from_pretrained('bert-base-uncased', cache_dir = hf_cache)
+
+    @staticmethod
+    def _load_encoder(hf_cache: str):
+        from transformers import BertModel
+        return optimize(BertModel.from_pretrained('bert-base-uncased', output_hidden_states = True, cache_dir = hf_cache))
+
+    tokenizer = property(lambda self: self._tokenizer.get())
+    encoder = property(lambda self: self._encoder.get())
+    synonym_table = property(lambda self: self._synonym_table.get())
+
+    def warm_up(self) -> None:
+        self._tokenizer.get()
+        self._encoder.get()
+        self._synonym_table.get()
 
     def _tokenize(self, query: str):
         return self.tokenizer.tokenize(query)
-    
-    def _similarity(self, x, y):
-        return self.cos_sim(x, y)
 
-    def _get_embedding(self, query: str):
-        tokens = self._tokenize('[CLS] ' + query + ' [SEP]')
-        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+    def _get_embeddings(self, sentences: List[str]) -> torch.Tensor:
+        """
+        Embeddings of many sentences. Those not in cache are computed together in one forward pass.
+        """
+        import torch
 
-        input_ids = torch.tensor(input_ids).unsqueeze(0)
-        with torch.no_grad():
-            outputs = self.encoder(input_ids)
-            embedding = outputs.last_hidden_state[0]
+        embeddings = [self._embeddings.get(s) for s in sentences]
+        missing = list(dict.fromkeys(s for s, e in zip(sentences, embeddings) if e is None))
+
+        if missing:
+            computed = dict(zip(missing, mean_pooled_embeddings(self.tokenizer, self.encoder, missing).clone().unbind()))
+
+            for sentence, embedding in computed.items():
+                self._embeddings.put(sentence, embedding)
+
+            embeddings = [e if e is not None else computed[s] for s, e in zip(sentences, embeddings)]
+
+        return torch.stack(embeddings)
 
-        return embedding.mean(dim = 0)
-    
     def _formattable_token(self, original: List[str], idx: int) -> str:
         tmp = original[:]
         tmp[idx] = '{}'
@@ -68,43 +331,7 @@ class ThesaurusQueryExpansion(QueryExpansionService):
         return fmt 
 
     def expand(self, query: str, max_results: int = 2, confidence_threshold: float = 0.9, connector: str = 'AND') -> str:
-        tokens = self._tokenize(query)
-        query_embedding = self._get_embedding(query)
-        expanded_query = []
-       
-        for idx, token in enumerate(tokens):
-            query_fmt = self._formattable_token(tokens, idx) 
-
-            candidates = (
-                pydash.chain([s.lemma_names() for s in wn.synsets(token)])
-                    .flatten_deep()
-                    .sorted_uniq()
-                    .map(lambda c: c.replace('_', ' '))
-                    .filter(lambda c: c.lower() != token.lower())  # Filters out duplicates
-                    .filter(lambda c: wn.morphy(c.lower()) != wn.morphy(token.lower()))  # Filters out morphed version of the token
-                    .value()
-            )
-
-            similarities = (
-                pydash.chain(candidates)
-                    .map(lambda c: query_fmt.format(c))
-                    .map(self._get_embedding)
-                    .map(lambda x: self._similarity(x, query_embedding))
-                    .value()
-            )
-
-            expansions = (
-                pydash.chain(candidates)
-                    .zip(similarities)
-                    .filter(lambda t: t[1] > confidence_threshold)
-                    .sort(key = itemgetter(1), reverse = True)
-                    .map(itemgetter(0))
-                    .take(max_results)
-                    .value()
-            )
-
-            # expanded_query += " " + ' '.join(expansions + [token])
-            expanded_query.append(expansions +  [token])
+        expanded_query = [expansions + [token] for token, expansions in self.expansions(query, max_results, confidence_threshold)]
 
         expanded_query = (
             pydash.chain(expanded_query)
@@ -122,38 +349,110 @@ class ThesaurusQueryExpansion(QueryExpansionService):
         expanded_query = ' '.join(expanded_query)
         return expanded_query
 
+    def expansions(self, query: str, max_results: int = 2, confidence_threshold: float = 0.9) -> List[Tuple[str, List[str]]]:
+        """
+        Tokens of `query`, each one with its expansions, most similar first.
+        """
+        import torch
+
+        tokens = self._tokenize(query)
+        prior_threshold = getattr(self.synonym_table, "threshold", None)
+        prior_threshold = confidence_threshold if prior_threshold is None else prior_threshold
+        priors: List[Optional[tuple]] = [self.synonym_table.get(token) for token in tokens]
+        # Tokens missing from the synonym table fall back to contextual scoring
+        candidates = [wordnet_candidates(token) if prior is None else () for token, prior in zip(tokens, priors)]
+        candidate_queries = [
+            self._formattable_token(tokens, idx).format(c)
+            for idx, token_candidates in enumerate(candidates)
+            for c in token_candidates
+        ]
+
+        similarities = []
+        if candidate_queries:
+            embeddings = self._get_embeddings([query] + candidate_queries)
+            similarities = torch.nn.functional.cosine_similarity(embeddings[1:], embeddings[:1], dim = 1).tolist()
+
+        token_expansions = []
+        offset = 0
+       
+        for token, token_candidates, prior in zip(tokens, candidates, priors):
+            token_similarities = similarities[offset:offset + len(token_candidates)]
+            offset += len(token_candidates)
+
+            threshold = prior_threshold if prior is not None else confidence_threshold
+            expansions = (
+                pydash.chain(prior if prior is not None else list(zip(token_candidates, token_similarities)))
+                    .filter(lambda t: t[1] > threshold)
+                    .sort(key = itemgetter(1), reverse = True)
+                    .map(itemgetter(0))
+                    .take(max_results)
+                    .value()
+            )
+
+            token_expansions.append((token, expansions))
+
+        return token_expansions
+
 class LLMQueryExpansion(QueryExpansionService):
     """
     A BERT-based - aka LLM-based - query expansion service.
+    All the masked variants of a query are filled in a single forward pass of the masked LM, then all the
+    candidate sequences are embedded, along with the query, in a single padded batch.
     """
     def __init__(self, hf_cache: str):
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', cache_dir = hf_cache)
-        self.encoder_model = BertModel.from_pretrained('bert-base-uncased', output_hidden_states = True, cache_dir = hf_cache)
+        self._models = Lazy(lambda: self._load_models(hf_cache))
+
+    @staticmethod
+    def _load_models(hf_cache: str):
+        from transformers import BertTokenizer, BertModel, BertForMaskedLM
+
+        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', cache_dir = hf_cache)
+        encoder_model = optimize(BertModel.from_pretrained('bert-base-uncased', output_hidden_states = True, cache_dir = hf_cache))
         
         from transformers import logging
         logging.set_verbosity_error()
-        unmasker_model = BertForMaskedLM.from_pretrained('bert-large-uncased-whole-word-masking', cache_dir = hf_cache, )
+        unmasker_model = optimize(BertForMaskedLM.from_pretrained('bert-large-uncased-whole-word-masking', cache_dir = hf_cache, ))
         logging.set_verbosity_warning()
-        
-        self.unmasker = FillMaskPipeline(model = unmasker_model, tokenizer = self.tokenizer, tokenizer_kwargs = {"truncation": True})
-        self.cos_sim = torch.nn.CosineSimilarity(dim  = 0)
+
+        return (tokenizer, encoder_model, unmasker_model)
+
+    tokenizer = property(lambda self: self._models.get()[0])
+    encoder_model = property(lambda self: self._models.get()[1])
+    unmasker_model = property(lambda self: self._models.get()[2])
+
+    def warm_up(self) -> None:
+        self._models.get()
     
     def _tokenize(self, query: str):
         return self.tokenizer.tokenize(query)
 
-    def _similarity(self, x, y):
-        return self.cos_sim(x, y)
+    def _fill_masks(self, masked_queries: List[str], top_k: int) -> List[List[Tuple[str, str]]]:
+        """
+        The `top_k` fillings of the mask of each query as (token, filled sequence) pairs, most likely first.
+        Equivalent to a fill-mask pipeline call per query, in a single padded forward pass.
+        """
+        import torch
 
-    def _get_embedding(self, query: str):
-        tokens = self._tokenize('[CLS] ' + query + ' [SEP]')
-        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+        batch = self.tokenizer(masked_queries, padding = True, truncation = True, return_tensors = 'pt')
 
-        input_ids = torch.tensor(input_ids).unsqueeze(0)
         with torch.no_grad():
-            outputs = self.encoder_model(input_ids)
-            embedding = outputs.last_hidden_state[0]
+            logits = self.unmasker_model(**batch).logits
+
+        rows, positions = torch.nonzero(batch['input_ids'] == self.tokenizer.mask_token_id, as_tuple = True)
+        predictions = logits[rows, positions].topk(top_k, dim = -1).indices
+        fills = []
+
+        for row, position, predicted in zip(rows.tolist(), positions.tolist(), predictions.tolist()):
+            input_ids = batch['input_ids'][row][batch['attention_mask'][row].bool()]
+            query_fills = []
+
+            for p in predicted:
+                input_ids[position] = p
+                query_fills.append((self.tokenizer.decode([p]), self.tokenizer.decode(input_ids, skip_special_tokens = True)))
 
-        return embedding.mean(dim = 0)
+            fills.append(query_fills)
+
+        return fills
     
     def _formattable_token(self, original: List[str], idx: int) -> str:
         tmp = original[:]
@@ -168,25 +467,26 @@ class LLMQueryExpansion(QueryExpansionService):
         return masked
 
     def expand(self, query: str, max_results: int = 2, confidence_threshold: float = 0.9, connector: str = 'AND', overprediction: int = 5) -> str:
+        import torch
+
         tokens = self._tokenize(query)
-        query_embedding = self._get_embedding(query)
         expanded_query = []
-       
-        for idx, token in enumerate(tokens):
-            candidates = self.unmasker(self._mask_token(['[CLS] '] + tokens + [' [SEP]'], idx+1), top_k = max_results*overprediction)
-
-            similarities = (
-                pydash.chain(candidates)
-                    .map(itemgetter('sequence'))  # Get complete sentence
-                    .map(self._get_embedding)
-                    .map(lambda x: self._similarity(x, query_embedding))
-                    .value()
-            )
 
+        if not tokens:
+            return ''
+
+        top_k = max_results * overprediction
+        fills = self._fill_masks([self._mask_token(['[CLS] '] + tokens + [' [SEP]'], idx + 1) for idx in range(len(tokens))], top_k)
+        sequences = [sequence for token_fills in fills for _, sequence in token_fills]  # Complete sentences
+
+        embeddings = mean_pooled_embeddings(self.tokenizer, self.encoder_model, [query] + sequences)
+        similarities = torch.nn.functional.cosine_similarity(embeddings[1:], embeddings[:1], dim = 1).tolist()
+       
+        for idx, (token, token_fills) in enumerate(zip(tokens, fills)):
             expansions = (
-                pydash.chain(candidates)
-                    .map(itemgetter('token_str'))
-                    .zip(similarities)
+                pydash.chain(token_fills)
+                    .map(itemgetter(0))
+                    .zip(similarities[idx * top_k:(idx + 1) * top_k])
                     .filter(lambda t: t[1] > confidence_threshold)
                     .sort(key = itemgetter(1), reverse = True)
                     .map(itemgetter(0))
@@ -213,14 +513,45 @@ class LLMQueryExpansion(QueryExpansionService):
         expanded_query = ' '.join(expanded_query)
         return expanded_query
 
+
 def main():
-    qe_wn = ThesaurusQueryExpansion('hf_cache')
-    qe_bert = LLMQueryExpansion('hf_cache')
+    from whoosh.index import open_dir
+
+    parser = argparse.ArgumentParser(
+        prog = "Placerank synonym table",
+        description = "Compare the expansions of the synonym table with the contextual ones and calibrate the threshold of its priors"
+    )
+
+    parser.add_argument('-t', '--table', default = SYNONYM_TABLE, help = 'Synonym table to check. Defaults to SYNONYM_TABLE.')
+    parser.add_argument('-b', '--benchmark', default = "validation/benchmark.json", help = 'Benchmark queries to compare on.')
+    parser.add_argument('-n', '--queries', type = int, default = 0, help = 'Queries synthesized from the index vocabulary on top of the benchmark ones. Defaults to 0.')
+    parser.add_argument('-c', '--calibrate', action = 'store_true', help = 'Store the best threshold in the table.')
+    parser.add_argument('--hf-cache', default = HF_CACHE, help = 'HuggingFace cache directory.')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    table = SynonymTable(args.table)
+    contextual = ThesaurusQueryExpansion(args.hf_cache)
+    lookup = ThesaurusQueryExpansion(args.hf_cache, args.table)
+    vocabulary = spelling_vocabulary(open_dir(INDEX_DIR)) if args.queries else []
+    queries = calibration_queries(vocabulary, args.benchmark, args.queries)
+
+    for query in queries:
+        expected, actual = contextual.expand(query), lookup.expand(query)
+        print(f"{'=' if expected == actual else '!'} {query}: {actual}" + ("" if expected == actual else f" (contextual: {expected})"))
+
+    expected = contextual_expansions(contextual, table, queries)
+    report = "{threshold:.2f}: precision {precision:.3f}, recall {recall:.3f}, F1 {f1:.3f}, tokens expanded alike {alike:.1%} of {tokens}"
+    best = calibrate_prior_threshold(table, expected)
+
+    if table.threshold is not None:
+        print("Table threshold " + report.format(**prior_agreement(table, expected, table.threshold)))
+    print("Best threshold " + report.format(**best))
+
+    if args.calibrate:
+        SynonymTable.write_threshold(args.table, best["threshold"])
+        print(f"Threshold {best['threshold']:.2f} stored in {args.table}")
 
-    query = 'modern shared room near harvard'
-    print(f'{query=}')
-    print(qe_wn.expand(query, 2, 0.9))
-    print(qe_bert.expand(query, 2, 0.9, 5))
 
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,162 @@
-from transformers import BertTokenizer, AutoModelForSequenceClassification, pipeline
+from __future__ import annotations
 from whoosh.scoring import WeightingModel, BM25F
 from placerank.views import ReviewsIndex
+from placerank.cache import Lazy
+from typing import Sequence
+from placerank import config
+from placerank.inference import optimize
+import copy
 import math
+import os
 import re
 import pydash
+import numpy as np
+
+
+def pick_device() -> str:
+    """
+    Fastest device available to torch: CUDA, then Apple MPS, then CPU.
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
 
 class GoEmotionsClassifier:
+    """
+    Multi-label emotion classifier. Texts are tokenized once, sorted by length and grouped in
+    batches of at most `max_tokens` padded tokens, so that short reviews are not padded up to long ones.
+    `device` defaults to the fastest one available; `num_threads` caps the torch CPU threads.
+    """
 
-    def __init__(self, model_name='original'):
-        self.tokenizer = BertTokenizer.from_pretrained(f"monologg/bert-base-cased-goemotions-{model_name}")
-        self.model = AutoModelForSequenceClassification.from_pretrained(f"monologg/bert-base-cased-goemotions-{model_name}", num_labels=28)
+    def __init__(self, model_name: str = config.HF_MODEL_GOEMOTIONS, device: str = None, num_threads: int = None, max_tokens: int = config.GOEMOTIONS_MAX_TOKENS, top_k: int = 2):
+        import torch
+        from transformers import BertTokenizer, AutoModelForSequenceClassification
 
+        if num_threads:
+            torch.set_num_threads(num_threads)
 
-    def create_pipeline(self):
-        self.goemotions = pipeline(
-            model=self.model,
-            tokenizer=self.tokenizer,
-            task="text-classification",
-            top_k=2,
-            function_to_apply='sigmoid',
-            device="mps"
-        )
+        self.device = device or pick_device()
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        self.tokenizer = BertTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name, num_labels=28)
+        self.model = optimize(self.model.to(self.device).eval(), device = self.device)
+
+    def _batches(self, lengths: Sequence[int]):
+        """
+        Indices of the texts grouped by similar length, longest first, within the token budget.
+        """
+        batch, longest = [], 0
 
+        for i in sorted(range(len(lengths)), key = lambda i: lengths[i], reverse = True):
+            if batch and max(longest, lengths[i]) * (len(batch) + 1) > self.max_tokens:
+                yield batch
+                batch, longest = [], 0
+
+            batch.append(i)
+            longest = max(longest, lengths[i])
+
+        if batch:
+            yield batch
 
     def classify_texts(self, texts):
-        if not hasattr(self, 'goemotions'):
-            self.create_pipeline()
-        return self.goemotions(texts)
+        """
+        The `top_k` labels of each text with their sigmoid score, in the same order and
+        format of the text classification pipeline.
+        """
+        import torch
+
+        input_ids = self.tokenizer(list(texts), truncation = True)["input_ids"]
+        labels = self.model.config.id2label
+        results = [None] * len(input_ids)
+
+        with torch.inference_mode():
+            for batch in self._batches([len(ids) for ids in input_ids]):
+                inputs = self.tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors = "pt").to(self.device)
+                scores, indices = torch.sigmoid(self.model(**inputs).logits).topk(self.top_k, dim = -1)
+
+                for i, row_scores, row_indices in zip(batch, scores.tolist(), indices.tolist()):
+                    results[i] = [{"label": labels[l], "score": s} for l, s in zip(row_indices, row_scores)]
+
+        return results
+
+    def classify_batches(self, batches):
+        """
+        Lazily classifies each batch of texts, in order.
+        """
+        return map(self.classify_texts, batches)
+
+
+_worker_classifier: GoEmotionsClassifier = None
+
+
+def _init_worker(model_name: str, num_threads: int) -> None:
+    global _worker_classifier
+    _worker_classifier = GoEmotionsClassifier(model_name, device = "cpu", num_threads = num_threads)
+
+
+def _classify_in_worker(texts):
+    return _worker_classifier.classify_texts(texts)
+
+
+class ParallelGoEmotionsClassifier:
+    """
+    Classifies batches of texts on `processes` CPU workers, each one with its own model and an
+    equal share of the cores, so that torch threads do not oversubscribe them.
+    To be used as a context manager, which shuts the workers down.
+    """
+
+    def __init__(self, processes: int, model_name: str = config.HF_MODEL_GOEMOTIONS):
+        import multiprocessing
+
+        threads = max(1, (os.cpu_count() or 1) // processes)
+        self.pool = multiprocessing.get_context("spawn").Pool(processes, _init_worker, (model_name, threads))
+
+    def classify_batches(self, batches):
+        """
+        Lazily classifies each batch of texts, in order.
+        """
+        return self.pool.imap(_classify_in_worker, batches)
+
+    def close(self):
+        self.pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
 
 class BaseSentimentWeightingModel(BM25F):
+    """
+    BM25F weighting combined with the similarity between the sentiment of the reviews of a listing
+    and the one the user asks for. Searches serving different users concurrently should each score
+    through their own `with_user_sentiment` copy, rather than setting the sentiment of a shared model.
+    """
+
     def __init__(self, reviews_index_path: str, *args, **kwargs):
         self.use_final = True
         self._user_sentiment = None
-        self._reviews_index = ReviewsIndex(reviews_index_path)
+        self._user_sentiment_vector = None
+        self._user_sentiment_norm = 0
+        self._reviews_index_loader = Lazy(lambda: ReviewsIndex(reviews_index_path))
         super().__init__(*args, **kwargs)
+
+    @property
+    def _reviews_index(self) -> ReviewsIndex:
+        """
+        The reviews index is loaded on first use, or ahead of it by `warm_up`.
+        """
+        return self._reviews_index_loader.get()
+
+    def warm_up(self) -> None:
+        self._reviews_index_loader.get()
     
     def _cosine_similarity(self, doc: dict, query: dict):
         """
@@ -50,7 +172,11 @@ class BaseSentimentWeightingModel(BM25F):
         return num / denom if denom else 0
     
     def _sentiment_score(self, listing_id, sentiment):
-        return self._cosine_similarity(self._get_sentiment_for(listing_id), sentiment)
+        """
+        Cosine similarity between the precomputed sentiment vector of the listing and the user one.
+        `sentiment` is unused, kept for compatibility: the user vector is built once by `set_user_sentiment`.
+        """
+        return self._reviews_index.similarity_for(listing_id, self._user_sentiment_vector, self._user_sentiment_norm)
     
     def _get_sentiment_for(self, listing_id):
         return self._reviews_index.get_sentiment_for(int(listing_id))
@@ -66,9 +192,40 @@ class BaseSentimentWeightingModel(BM25F):
             .value()
         )
 
-        self._user_sentiment = {k: 1 if k not in negated_sentiments else -1 for k in user_sentiment.split(" ")}
+        self._user_sentiment = {k: 1 if k not in negated_sentiments else -1 for k in user_sentiment.split()}
         if 'not' in self._user_sentiment: del self._user_sentiment['not']
 
+        self._user_sentiment_vector = self._reviews_index.vectorize(self._user_sentiment)
+        self._user_sentiment_norm = float(np.linalg.norm(self._user_sentiment_vector))
+
+
+    def with_user_sentiment(self, user_sentiment) -> BaseSentimentWeightingModel:
+        """
+        A shallow copy of the model, scoring with `user_sentiment`, that leaves this one untouched.
+        Copies share the reviews index, so creating one per search is cheap.
+        """
+        scorer = copy.copy(self)
+        scorer.set_user_sentiment(user_sentiment)
+        return scorer
+
+    def has_user_sentiment(self) -> bool:
+        return bool(self._user_sentiment)
+
+    def lexical_model(self) -> BM25F:
+        """
+        Plain BM25F model with the same parameters, to retrieve candidates without sentiment weighting.
+        """
+        return BM25F(self.B, self.K1, **{f"{field}_B": B for field, B in self._field_B.items()})
+
+    def rerank(self, ids: Sequence[str], textual_scores: np.ndarray) -> np.ndarray:
+        """
+        Vectorized counterpart of `final`: combine the textual scores of a whole candidate set
+        with the user sentiment at once.
+        """
+        if not self._user_sentiment: return textual_scores
+
+        sentiment_scores = self._reviews_index.similarities(ids, self._user_sentiment_vector)
+        return self._combine_scores(textual_scores, sentiment_scores)
 
     def final(self, searcher, docnum, textual_score):
         textual_score = super().final(searcher, docnum, textual_score)
@@ -85,6 +242,14 @@ class AdvancedSentimentWeightingModel(BaseSentimentWeightingModel):
         tmp = textual_score * sentiment_score * self._reviews_index.get_sentiment_len_for(id)
         return tmp
 
+    def rerank(self, ids: Sequence[str], textual_scores: np.ndarray) -> np.ndarray:
+        textual_scores = super().rerank(ids, textual_scores)
+
+        if not self._user_sentiment: return textual_scores
+
+        sentiment_scores = self._reviews_index.similarities(ids, self._user_sentiment_vector)
+        return textual_scores * sentiment_scores * self._reviews_index.get_sentiment_lens_for(ids)
+
     def final(self, searcher, docnum, textual_score):
         textual_score = super().final(searcher, docnum, textual_score)
 
@@ -7,13 +7,24 @@ a new query; but the update can also be a change of `IRModel`.
 The new content is afterwards sent to the view through the broker, once again.
 From a practical point of view, `Presenter` is a singleton, of which the view is unaware, while the
 model being injected as a dependency in it. 
+Once attached to the urwid main loop, searches run on a worker thread, so that the UI never blocks:
+results are posted back to the loop thread through a pipe and only then dispatched to the view.
+A newer query supersedes older ones, whose results are dropped.
+The worker is a daemon thread, so quitting never waits for it: not even while it loads the models.
 """
 from __future__ import annotations
 from placerank.ir_model import IRModel
 from placerank.tui.events import Event, Events, Observer
-from placerank.views import QueryView, ResultView, ReviewView, DocumentView
-from placerank.dataset import ReviewsDatabase, load_page
+from placerank.views import QueryView, ResultView, ReviewView, DocumentView, SearchResult
+from placerank.dataset import ReviewsDatabase, ListingStore
+from collections import deque
+from typing import Callable
+from urwid import MainLoop
+import functools
+import os
+import queue
 import re
+import threading
 
 from whoosh.index import Index
 from whoosh import qparser
@@ -27,32 +38,109 @@ class Presenter:
             cls.__instance = super().__new__(cls)
         return cls.__instance
 
-    def __init__(self, model: IRModel, local_dataset: str, reviews_database: ReviewsDatabase):
+    def __init__(self, model: IRModel, listing_store: ListingStore, reviews_database: ReviewsDatabase):
         self._model = model
-        self._local_dataset = local_dataset
+        self._listing_store = listing_store
         self._reviews_database = reviews_database
         self._line_break_regex = re.compile(r'\s*<\s*br\s*/?>\s*')
         self.search_observser = Observer(self.search_query_update, [Events.SEARCH_QUERY_UPDATE.value])
         self.open_result_request_observer = Observer(self.open_result_request, [Events.OPEN_RESULT_REQUEST.value])
         self.autoexpansion_observer = Observer(self.autoexpansion_change, [Events.AUTOEXPANSION_STATE_CHANGE.value])
+
+        self._tasks: queue.SimpleQueue[Callable[[], None]] = queue.SimpleQueue()
+        self._worker = threading.Thread(target = self._work, name = 'placerank-search', daemon = True)
+        self._wakeup_fd: int = None
+        self._lock = threading.Lock()
+        self._ticket = 0
+        self._outbox = deque()
+
+    def _work(self) -> None:
+        """
+        Runs on the worker thread, until `close` posts None.
+        """
+        while (task := self._tasks.get()) is not None:
+            task()
+
+    def attach(self, loop: MainLoop) -> None:
+        """
+        From now on, dispatch searches off the UI thread and post their results back to `loop`.
+        """
+        self._wakeup_fd = loop.watch_pipe(self._deliver_results)
+        self._worker.start()
+
+    def warm_up(self) -> None:
+        """
+        Load models and databases in the background, on the search worker, so that the UI comes up first.
+        """
+        self._tasks.put(self._warm_up)
+
+    def _warm_up(self) -> None:
+        try:
+            self._model.warm_up()
+            self._reviews_database.warm_up()
+        except Exception:
+            pass  # Searches load whatever is missing on their own, and report the failure
+
+    def close(self) -> None:
+        """
+        Stop the worker once its current task is over, without waiting for it.
+        """
+        self._tasks.put(None)
     
     def search_query_update(self, event: Event, query: QueryView) -> None:
-        (results, tot_len) = self._model.search(query, limit = 50)
-        
-        if (cq := self._model.spell_corrector.correct(query)) != query.textual_query:
+        if self._wakeup_fd is None:
+            self._publish_results(query, self._model.search(query, limit = 50))
+            return
+
+        with self._lock:
+            self._ticket += 1
+            self._tasks.put(functools.partial(self._search_task, self._ticket, query))  # Superseded searches are skipped
+
+    def _search_task(self, ticket: int, query: QueryView) -> None:
+        """
+        Runs on the worker thread.
+        """
+        if ticket != self._ticket: return
+
+        try:
+            result = self._model.search(query, limit = 50)
+        except Exception as e:
+            result = e
+
+        self._outbox.append((ticket, query, result))
+        os.write(self._wakeup_fd, b'.')
+
+    def _deliver_results(self, _: bytes) -> bool:
+        """
+        Runs on the UI thread, whenever the worker posts something.
+        """
+        while self._outbox:
+            ticket, query, result = self._outbox.popleft()
+
+            if ticket != self._ticket: continue  # Stale, a newer query is on its way
+
+            if isinstance(result, Exception): raise result
+            self._publish_results(query, result)
+
+        return True
+
+    def _publish_results(self, query: QueryView, result: SearchResult) -> None:
+        if (cq := result.corrected_query) != query.textual_query:
             Events.DID_YOU_MEAN.value.notify(cq)
         else:
             Events.DID_YOU_MEAN.value.notify('')
         
-        if (eq := self._model.query_expander.expand(query.textual_query)) != query.textual_query:
+        if (eq := result.expanded_query) != query.textual_query:
             Events.EXPANDED_ALTERNATIVE.value.notify(eq)
         else:
             Events.EXPANDED_ALTERNATIVE.value.notify(' ')
 
-        Events.SEARCH_RESULTS_UPDATE.value.notify(results, tot_len)
+        Events.SEARCH_RESULTS_UPDATE.value.notify(result.results, result.total)
 
     def open_result_request(self, event: Event, doc_id: int) -> None:
-        page = load_page(self._local_dataset, doc_id)
+        page = self._listing_store.get(doc_id)
+
+        if not page: return
 
         cleaned_page = DocumentView(*(self._line_break_regex.sub('\n', field) if type(field) is str else field for field in page))
         cleaned_reviews = [
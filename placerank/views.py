@@ -1,13 +1,13 @@
 from __future__ import annotations
-from typing import Dict, NamedTuple, Tuple
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
 from placerank.preprocessing import get_default_analyzer
 from whoosh.fields import FieldType, Schema, ID, TEXT, KEYWORD
 from enum import Flag, auto, verify, NAMED_FLAGS
 from datetime import datetime
 from operator import itemgetter
 from collections import defaultdict
-import math
-import pickle
+import hashlib
+import numpy as np
 
 class InsideAirbnbSchema(Schema):
     """
@@ -27,7 +27,7 @@ class InsideAirbnbSchema(Schema):
             "neighborhood_overview": TEXT(analyzer=get_default_analyzer(), spelling=True, sortable=True)
         }
         
-        super().__init__(**self.logicview)
+        super().__init__(**self.logicview, digest = ID(stored = True))
 
     def get_document_logic_view(self, record: dict) -> dict:
         """
@@ -36,6 +36,19 @@ class InsideAirbnbSchema(Schema):
         """
         return {k:record[k] for k in self.logicview.keys()}
 
+    def get_document_digest(self, record: dict) -> str:
+        """
+        Content hash of the keys specified in `self.logicview`.
+        Tells whether an indexed document is out of date with respect to a new record.
+        """
+        h = hashlib.blake2b(digest_size = 16)
+
+        for k in self.logicview.keys():
+            h.update(record[k].encode())
+            h.update(b"\0")
+
+        return h.hexdigest()
+
 class DocumentView(NamedTuple):
     """
     Adapter class to a document that instances an immutable tuple
@@ -92,65 +105,187 @@ class ResultView(NamedTuple):
     room_type: str
     score: float
 
+    @staticmethod
+    def from_hit(fields: dict, score: float) -> ResultView:
+      return ResultView(**{k: fields[k] for k in ResultView._fields if k != "score"}, score = score)
+
+class SearchResult(NamedTuple):
+    """
+    Adapter class to the outcome of a search that instances an immutable tuple.
+    Its first two fields keep it indexable as the former `(results, total_hits)` pair.
+    `timings` maps each stage of the search to the seconds spent in it.
+    """
+    results: List[ResultView]
+    total: int
+    expanded_query: str
+    corrected_query: str
+    timings: Dict[str, float]
+
+
+GOEMOTIONS_LABELS: Tuple[str, ...] = (
+    "admiration", "amusement", "anger", "annoyance", "approval", "caring", "confusion",
+    "curiosity", "desire", "disappointment", "disapproval", "disgust", "embarrassment", "excitement",
+    "fear", "gratitude", "grief", "joy", "love", "nervousness", "optimism",
+    "pride", "realization", "relief", "remorse", "sadness", "surprise", "neutral"
+)
+
 
 class ReviewsIndex:
-    def __init__(self, path = "reviews.pickle"):
-        with open(path, "rb") as fp:
-            self.index = pickle.load(fp)
+    """
+    Sentiment of the reviews of each listing, stored as parallel NumPy arrays in a `.npz` file:
+     - `listings` and `offsets`: sorted listing ids and the bounds of their reviews in the arrays below
+     - `review_ids`, `dates`: review ids and dates as day ordinals
+     - `labels`, `scores`: the top GoEmotions labels of each review, with their scores
+     - `vectors`, `norms`: the exponentially decayed sentiment vector of each listing - one column per
+       GoEmotions label - precomputed at build time, and its L2 norm
+    """
 
-    def __todate(self, s: str):
-        return datetime.strptime(s, "%Y-%m-%d")
-    
-    def get_sentiment_len_for(self, key):
-        tmp = self.index.get(int(key), {})
-        return len(tmp)
+    TAU_DIV = 90
+    LABELS_MAP = {label: i for i, label in enumerate(GOEMOTIONS_LABELS)}
 
-    def get_sentiment_for(self, key, tau_div = 90):
+    def __init__(self, path = "reviews.npz"):
+        with np.load(path) as index:
+            self.listings = index["listings"]
+            self.offsets = index["offsets"]
+            self.review_ids = index["review_ids"]
+            self.dates = index["dates"]
+            self.labels = index["labels"]
+            self.scores = index["scores"]
+            self.vectors = index["vectors"]
+            self.norms = index["norms"]
+
+        self.rows = {id: row for row, id in enumerate(self.listings.tolist())}
+
+    @classmethod
+    def save(cls, path: str, listing_ids: np.ndarray, review_ids: np.ndarray, dates: np.ndarray, labels: np.ndarray, scores: np.ndarray):
         """
-        Return the sentiment by exponential decay mean.
+        Store the classified reviews - one entry per review, in any order - along with
+        the sentiment vectors they decay to.
+        `labels` and `scores` hold the same number of top labels for each review.
         """
+        order = np.argsort(listing_ids, kind = "stable")
+        listing_ids, review_ids, dates = listing_ids[order], review_ids[order], dates[order]
+        labels, scores = labels[order], scores[order]
 
-        reviews = self.index.get(key)
-        
-        if not reviews:
-            return {}
-        
-        reference_date = max([x for x in map(itemgetter(1), reviews)])
+        listings, starts = np.unique(listing_ids, return_index = True)
+        offsets = np.append(starts, len(listing_ids)).astype(np.int64)
+        vectors = cls.compute_sentiment_vectors(offsets, dates, labels, scores)
 
-        def decay(date):
-            return math.e ** (- ((reference_date - date).days) / tau_div)
-        
-        sentiment_vector = defaultdict(int)
+        np.savez(
+            path,
+            listings = listings.astype(np.int64), offsets = offsets,
+            review_ids = review_ids.astype(np.int64), dates = dates.astype(np.int32),
+            labels = labels.astype(np.uint8), scores = scores.astype(np.float32),
+            vectors = vectors, norms = np.linalg.norm(vectors, axis = 1)
+        )
 
-        for rid, date, sentiments in reviews:
-            for sentiment in sentiments:
-                sentiment_vector[sentiment.get("label")] += sentiment.get("score") * decay(date)
+    @staticmethod
+    def compute_sentiment_vectors(offsets: np.ndarray, dates: np.ndarray, labels: np.ndarray, scores: np.ndarray, tau_div = TAU_DIV) -> np.ndarray:
+        """
+        Decayed sentiment matrix of reviews grouped by listing, as delimited by `offsets`.
+        Each review weighs e^(-d / tau_div), d being the days between it and the latest review of the listing.
+        """
+        vectors = np.zeros((len(offsets) - 1, len(GOEMOTIONS_LABELS)), dtype = np.float32)
+
+        if not len(dates):
+            return vectors
+
+        groups = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        reference_dates = np.maximum.reduceat(dates, offsets[:-1])
+        decay = np.exp(- (reference_dates[groups] - dates) / tau_div)
+        np.add.at(vectors, (groups[:, None], labels), scores * decay[:, None])
 
-        return sentiment_vector
+        return vectors
 
-    def get_mean_sentiment_for(self, key, lambda_mult = 1):
+    def _reviews_of(self, key) -> Optional[slice]:
+        row = self.rows.get(int(key))
+        return slice(self.offsets[row], self.offsets[row + 1]) if row is not None else None
+
+    def vectorize(self, sentiment: dict) -> np.ndarray:
         """
-        Return the sentiment by simple averaging.
+        Map a label-to-weight dictionary to the space of the sentiment vectors. Unknown labels are dropped.
         """
+        vector = np.zeros(len(GOEMOTIONS_LABELS), dtype = np.float32)
 
-        reviews = self.index.get(key)
-        
-        if not reviews:
+        for label, weight in sentiment.items():
+            if label in self.LABELS_MAP:
+                vector[self.LABELS_MAP[label]] = weight
+
+        return vector
+
+    @staticmethod
+    def _to_dict(vector: np.ndarray) -> Dict[str, float]:
+        return defaultdict(int, {GOEMOTIONS_LABELS[i]: float(vector[i]) for i in np.flatnonzero(vector)})
+
+    def get_sentiment_vector_for(self, key) -> Optional[np.ndarray]:
+        row = self.rows.get(int(key))
+        return self.vectors[row] if row is not None else None
+
+    def similarity_for(self, key, query: np.ndarray, query_norm: float) -> float:
+        """
+        Cosine similarity between the sentiment vector of a listing and a query vector, whose norm is given.
+        """
+        row = self.rows.get(int(key))
+
+        if row is None:
+            return 0
+
+        denom = self.norms[row] * query_norm
+        return float(self.vectors[row] @ query / denom) if denom else 0
+
+    def similarities(self, keys: Sequence, query: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarities between the sentiment vectors of many listings and a query vector, in one shot.
+        Listings without reviews score 0.
+        """
+        rows = np.fromiter((self.rows.get(int(k), -1) for k in keys), dtype = np.int64, count = len(keys))
+        found = rows >= 0
+        similarities = np.zeros(len(rows), dtype = np.float32)
+
+        num = self.vectors[rows[found]] @ query
+        denom = self.norms[rows[found]] * np.linalg.norm(query)
+        similarities[found] = np.divide(num, denom, out = np.zeros_like(num), where = denom > 0)
+
+        return similarities
+
+    def get_sentiment_len_for(self, key):
+        row = self.rows.get(int(key))
+        return int(self.offsets[row + 1] - self.offsets[row]) if row is not None else 0
+
+    def get_sentiment_lens_for(self, keys: Sequence) -> np.ndarray:
+        rows = np.fromiter((self.rows.get(int(k), -1) for k in keys), dtype = np.int64, count = len(keys))
+        lens = (self.offsets[rows + 1] - self.offsets[rows]).astype(np.float32)
+        lens[rows < 0] = 0
+        return lens
+
+    def get_sentiment_for(self, key, tau_div = TAU_DIV):
+        """
+        Return the sentiment by exponential decay mean.
+        """
+
+        if tau_div == self.TAU_DIV:
+            vector = self.get_sentiment_vector_for(key)
+            return self._to_dict(vector) if vector is not None else {}
+
+        reviews = self._reviews_of(key)
+
+        if reviews is None:
             return {}
-        
-        reference_date = max([datetime.strptime(x, "%Y-%m-%d") for x in map(itemgetter(1), reviews)])
 
-        def decay(date):
-            date = self.__todate(date)
-            return math.e ** (- lambda_mult * ((reference_date - date).days))
-        
-        sentiment_vector = defaultdict(int)
+        offsets = np.array([0, reviews.stop - reviews.start])
+        vectors = self.compute_sentiment_vectors(offsets, self.dates[reviews], self.labels[reviews], self.scores[reviews], tau_div)
+        return self._to_dict(vectors[0])
 
-        for rid, date, sentiments in reviews:
-            for sentiment in sentiments:
-                sentiment_vector[sentiment.get("label")] += sentiment.get("score")
+    def get_mean_sentiment_for(self, key):
+        """
+        Return the sentiment by simple averaging of the scores of the reviews.
+        """
+
+        reviews = self._reviews_of(key)
 
-            for k, v in sentiment_vector.items():
-                sentiment_vector[k] = v / len(sentiments)
+        if reviews is None:
+            return {}
 
-        return sentiment_vector
+        labels, scores = self.labels[reviews], self.scores[reviews]
+        vector = np.bincount(labels.ravel(), weights = scores.ravel(), minlength = len(GOEMOTIONS_LABELS))
+        return self._to_dict(vector / labels.shape[0])
@@ -13,10 +13,14 @@ def main():
     # Computes sentiment for each entry
     dataset.build_reviews_index(REVIEWS_URL)
 
-    # Populate an in-memory database of reviews using REVIEWS_DATASET_CACHE_FILE, stored in REVIEWS_DB
+    # Populate a memory-mapped, columnar database of reviews using REVIEWS_DATASET_CACHE_FILE, stored in REVIEWS_DB
     dataset.ReviewsDatabase(REVIEWS_CACHE_FILE)
     
     query_expansion.setup([HF_MODEL_MASKING, HF_MODEL_ENCODING], HF_CACHE)
 
+    # Precomputes WordNet candidates and their similarity priors for the spelling vocabulary of the index, stored in SYNONYM_TABLE
+    # along with the threshold of the priors that best reproduces the contextual expansions
+    query_expansion.build_synonym_table(INDEX_DIR, HF_CACHE)
+
 if __name__ == "__main__":
     main()